@@ -37,6 +37,7 @@ from tbp.monty.frameworks.models.motor_system import MotorSystem
 from custom_classes.config import PlottingConfig
 from custom_classes.dataloader import UltrasoundDataLoader
 from custom_classes.environment import (
+    EpisodeFileUltrasoundEnvironment,
     JSONDatasetUltrasoundEnvironment,
     UltrasoundEnvironment,
 )
@@ -180,6 +181,17 @@ json_dataset_ultrasound_experiment["dataset_args"]["env_init_args"] = {
     # ),
 }
 
+# Same as json_dataset_ultrasound_experiment but reading binary episode files
+# (created with convert_json_dataset.py), which load much faster. Each episode file
+# in the data_path directory is used as one episode.
+episode_dataset_ultrasound_experiment = deepcopy(json_dataset_ultrasound_experiment)
+episode_dataset_ultrasound_experiment["dataset_args"]["env_init_func"] = (
+    EpisodeFileUltrasoundEnvironment
+)
+episode_dataset_ultrasound_experiment["dataset_args"]["env_init_args"] = {
+    "data_path": os.path.join(os.environ["MONTY_DATA"], "ultrasound_test_set/"),
+}
+
 # For learning we use the DisplacementGraphLM.
 LM_config_for_learning = {
     "learning_module_0": {
@@ -316,12 +328,21 @@ probe_triggered_data_collection_experiment["monty_config"]["monty_args"] = Monty
 probe_triggered_data_collection_experiment["plotting_config"] = PlottingConfig(
     enabled=False
 )
+# Runs against load_test.py on the same computer instead of the iPad and tracker
+probe_triggered_load_test_experiment = deepcopy(probe_triggered_experiment)
+probe_triggered_load_test_experiment["dataset_args"]["env_init_args"] = {
+    "image_listen_port": 3000,
+    "vive_url": "http://localhost:3001/pose",
+}
+probe_triggered_load_test_experiment["plotting_config"] = PlottingConfig(enabled=False)
 
 CONFIGS = {
     "base_ultrasound_experiment": base_ultrasound_experiment,
     "json_dataset_ultrasound_experiment": json_dataset_ultrasound_experiment,
+    "episode_dataset_ultrasound_experiment": episode_dataset_ultrasound_experiment,
     "json_dataset_ultrasound_learning_meat_can": json_dataset_ultrasound_learning_meat_can,
     "json_dataset_ultrasound_learning_numenta_mug": json_dataset_ultrasound_learning_numenta_mug,
     "probe_triggered_experiment": probe_triggered_experiment,  # Default of only a few eval steps --> can use for demo
     "probe_triggered_data_collection_experiment": probe_triggered_data_collection_experiment,
+    "probe_triggered_load_test_experiment": probe_triggered_load_test_experiment,
 }
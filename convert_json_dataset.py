@@ -0,0 +1,59 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Convert JSON datasets into binary episode files.
+
+Each dataset directory with {step}.json files becomes one episode file (see
+custom_classes/episode_file.py), e.g.
+
+    python convert_json_dataset.py ~/tbp/data/ultrasound_test_set/demo_object_spam
+
+writes demo_object_spam.episode next to the dataset directory. The images are
+stored as uint8, so the (mean of RGB) pixel values of the JSON files are rounded
+to the nearest integer.
+"""
+
+import argparse
+import os
+import time
+
+from custom_classes.episode_file import EPISODE_FILE_SUFFIX, convert_json_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "data_paths", nargs="+", help="JSON dataset directories to convert."
+    )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        default=None,
+        help="Directory to write the episode files to. Defaults to the parent "
+        "directory of each dataset.",
+    )
+    args = parser.parse_args()
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    for data_path in args.data_paths:
+        episode_path = None
+        if args.output_dir is not None:
+            dataset_name = os.path.basename(os.path.normpath(data_path))
+            episode_path = os.path.join(
+                args.output_dir, dataset_name + EPISODE_FILE_SUFFIX
+            )
+        start_time = time.time()
+        episode_path = convert_json_dataset(data_path, episode_path)
+        print(f"Wrote {episode_path} in {time.time() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Index of the scenes of an ultrasound dataset.
+
+The index is built once by index_dataset.py and stored as index.json in the
+dataset directory. It lists every scene with its format, number of steps, step
+files or frame byte offsets, image shape and the range of the agent positions.
+Environments created with use_dataset_index=True take the dataset structure from
+the index instead of listing directories and probing for step files.
+
+Supported scene formats:
+    "json": directory with {step}.json files (JSONDatasetUltrasoundEnvironment).
+        If the dataset directory itself contains 0.json, it is the only scene
+        and its name is "".
+    "png": directory with img_{step}.png files (UltrasoundEnvironment).
+    "episode": episode file (EpisodeFileUltrasoundEnvironment).
+"""
+
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from custom_classes.episode_file import EPISODE_FILE_SUFFIX, EpisodeFile
+
+INDEX_FILE_NAME = "index.json"
+INDEX_VERSION = 1
+
+
+def build_dataset_index(data_path):
+    """Build the index of a dataset and write it to the dataset directory.
+
+    JSON scenes are parsed completely to get the image shape and pose range, so
+    this can take a while for large datasets.
+
+    Args:
+        data_path: Dataset directory.
+
+    Returns:
+        dict: The index.
+    """
+    if os.path.exists(os.path.join(data_path, "0.json")):
+        scenes = [_index_json_scene(data_path, "")]
+    else:
+        scenes = []
+        for name in sorted(os.listdir(data_path)):
+            path = os.path.join(data_path, name)
+            if name.startswith("."):
+                continue
+            if name.endswith(EPISODE_FILE_SUFFIX) and os.path.isfile(path):
+                scenes.append(_index_episode_scene(data_path, name))
+            elif os.path.exists(os.path.join(path, "0.json")):
+                scenes.append(_index_json_scene(data_path, name))
+            elif os.path.exists(os.path.join(path, "img_0.png")):
+                scenes.append(_index_png_scene(data_path, name))
+
+    index = {"version": INDEX_VERSION, "scenes": scenes}
+    with open(os.path.join(data_path, INDEX_FILE_NAME), "w") as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+class DatasetIndex:
+    """Read access to the index of a dataset."""
+
+    def __init__(self, data_path):
+        """Load the index of a dataset.
+
+        Args:
+            data_path: Dataset directory containing the index.
+
+        Raises:
+            FileNotFoundError: If the dataset has no index.
+            ValueError: If the index was written in an unknown format.
+        """
+        self.data_path = data_path
+        index_path = os.path.join(data_path, INDEX_FILE_NAME)
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(
+                f"No dataset index found at {index_path}. "
+                "Create it with index_dataset.py."
+            )
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        if index["version"] != INDEX_VERSION:
+            raise ValueError(f"Unsupported dataset index version {index['version']}")
+        self.scenes = {scene["name"]: scene for scene in index["scenes"]}
+
+    @property
+    def scene_names(self):
+        return list(self.scenes)
+
+    def get_num_steps(self, scene_name):
+        return self.scenes[scene_name]["num_steps"]
+
+    def get_scene_path(self, scene_name):
+        return os.path.join(self.data_path, scene_name)
+
+    def get_step_path(self, scene_name, step):
+        """Get the path of the file of a step in a json or png scene.
+
+        Raises:
+            IndexError: If the scene has no such step.
+        """
+        step_files = self.scenes[scene_name]["step_files"]
+        if not 0 <= step < len(step_files):
+            raise IndexError(f"Scene {scene_name!r} has no step {step}")
+        return os.path.join(self.data_path, scene_name, step_files[step])
+
+    def get_episode_layout(self, scene_name):
+        """Get the layout of the file of an episode scene.
+
+        Returns:
+            dict: The "num_frames", "height", "width", "images_offset" and
+                "records_offset" of the file, to open it with
+                EpisodeFile(path, layout) without reading its header. Frame i
+                starts at images_offset + i * frame_bytes.
+        """
+        scene = self.scenes[scene_name]
+        height, width = scene["image_shape"]
+        return {
+            "num_frames": scene["num_steps"],
+            "height": height,
+            "width": width,
+            "images_offset": scene["images_offset"],
+            "records_offset": scene["records_offset"],
+        }
+
+
+def _index_json_scene(data_path, name):
+    step_files, positions = [], []
+    image_shape = None
+    while os.path.exists(os.path.join(data_path, name, f"{len(step_files)}.json")):
+        step_file = f"{len(step_files)}.json"
+        with open(os.path.join(data_path, name, step_file), "r") as f:
+            data = json.load(f)
+        if image_shape is None:
+            image = np.asarray(data["obs"]["agent_id_0"]["ultrasound"]["img"])
+            image_shape = list(image.shape)
+        positions.append(data["state"]["agent_id_0"]["position"])
+        step_files.append(step_file)
+    return {
+        "name": name,
+        "format": "json",
+        "num_steps": len(step_files),
+        "image_shape": image_shape,
+        "step_files": step_files,
+        "pose_range": _get_pose_range(positions),
+    }
+
+
+def _index_png_scene(data_path, name):
+    step_files = []
+    while os.path.exists(os.path.join(data_path, name, f"img_{len(step_files)}.png")):
+        step_files.append(f"img_{len(step_files)}.png")
+    # Only reads the image header
+    with Image.open(os.path.join(data_path, name, step_files[0])) as image:
+        width, height = image.size
+    return {
+        "name": name,
+        "format": "png",
+        "num_steps": len(step_files),
+        # Grayscale shape, after averaging the color channels
+        "image_shape": [height, width],
+        "step_files": step_files,
+        # PNG scenes have no poses
+        "pose_range": None,
+    }
+
+
+def _index_episode_scene(data_path, name):
+    episode_file = EpisodeFile(os.path.join(data_path, name))
+    num_steps, height, width = episode_file.images.shape
+    return {
+        "name": name,
+        "format": "episode",
+        "num_steps": num_steps,
+        "image_shape": [height, width],
+        "images_offset": episode_file.images_offset,
+        "frame_bytes": height * width,
+        "records_offset": episode_file.records_offset,
+        "pose_range": _get_pose_range(episode_file.records["agent_position"]),
+    }
+
+
+def _get_pose_range(positions):
+    if len(positions) == 0:
+        return None
+    positions = np.asarray(positions, dtype=float)
+    return {
+        "min_position": positions.min(axis=0).tolist(),
+        "max_position": positions.max(axis=0).tolist(),
+    }
@@ -8,7 +8,6 @@
 # https://opensource.org/licenses/MIT.
 import json
 import os
-import time
 
 import numpy as np
 import PIL
@@ -19,6 +18,11 @@ from tbp.monty.frameworks.environments.two_d_data import (
     EmbodiedEnvironment,
 )
 
+from custom_classes.dataset_index import DatasetIndex
+from custom_classes.episode_file import EPISODE_FILE_SUFFIX, EpisodeFile
+from custom_classes.feature_sidecar import FeatureSidecar
+from custom_classes.frame_watcher import FrameWatcher
+
 
 class UltrasoundActionSpace(tuple, ActionSpace):
     """Action space placeholder (Monty doesn't act here)."""
@@ -34,18 +38,38 @@ class UltrasoundEnvironment(EmbodiedEnvironment):
     JSONDatasetUltrasoundEnvironment or ProbeTriggeredUltrasoundEnvironment for
     actual data loading and state retrieval.
     """
-    def __init__(self, data_path=None):
+    def __init__(self, data_path=None, use_dataset_index=False, frame_watch="auto"):
         """Initialize environment.
 
         Args:
             patch_size: height and width of patch in pixels, defaults to 64
             data_path: path to the image dataset. If None its set to
                 ~/tbp/data/ultrasound/ultrasound_stream/
+            use_dataset_index: If True, the scenes, their number of steps and
+                their step files are taken from the dataset index (created with
+                index_dataset.py) instead of the file system. Episodes then end
+                after the last indexed step.
+            frame_watch: How to wait for images that are still being streamed
+                into the scene directory. "inotify" wakes up when a file is
+                written, "polling" checks the file system every 50ms, "auto" uses
+                inotify where it is available.
+
+        Raises:
+            ValueError: If frame_watch is not a known method.
         """
+        if frame_watch not in ("auto", "inotify", "polling"):
+            raise ValueError(f"Unknown frame_watch method: {frame_watch}")
         self.data_path = data_path
         self.full_image = None  # Store the full image for plotting
-
-        self.scene_names = [a for a in os.listdir(self.data_path) if a[0] != "."]
+        self.frame_watch = frame_watch
+        self._frame_watcher = None
+
+        if use_dataset_index:
+            self.dataset_index = DatasetIndex(data_path)
+            self.scene_names = self.dataset_index.scene_names
+        else:
+            self.dataset_index = None
+            self.scene_names = [a for a in os.listdir(self.data_path) if a[0] != "."]
         self.current_scene = 0
         self.step_count = 0
 
@@ -70,8 +94,11 @@ class UltrasoundEnvironment(EmbodiedEnvironment):
             action: load the next image + tracking data.
 
         Returns:
-            observation (dict).
+            observation (dict), None after the last step of an indexed scene.
         """
+        num_steps = self.get_num_steps()
+        if num_steps is not None and self.step_count >= num_steps:
+            return None
         self.current_ultrasound_image = self.load_next_ultrasound_image()
 
         obs = {
@@ -85,30 +112,41 @@ class UltrasoundEnvironment(EmbodiedEnvironment):
         return obs
 
     def load_next_ultrasound_image(self):
+        if self.dataset_index is not None:
+            return self.load_ultrasound_image(
+                self.dataset_index.get_step_path(self.get_scene_name(), self.step_count)
+            )
         current_img_path = (
             self.data_path
             + f"{self.scene_names[self.current_scene]}/img_{self.step_count}.png"
         )
         print(f"Looking for ultrasound image from {current_img_path}")
+        scene_directory, file_name = os.path.split(current_img_path)
+        frame_watcher = self.get_frame_watcher(scene_directory)
         # Load ultrasound image
-        wait_count = 0
-        while not os.path.exists(current_img_path):
-            if wait_count % 10 == 0:
-                # Print every 10 seconds
+        existing_ok = True
+        while True:
+            # Print every 10 seconds
+            if not frame_watcher.wait_for_file(
+                file_name, timeout=10, existing_ok=existing_ok
+            ):
                 print("Waiting for new ultrasound data...")
-            time.sleep(1)
-            wait_count += 1
-
-        load_succeeded = False
-        while not load_succeeded:
+                continue
             try:
-                current_ultrasound_image = self.load_ultrasound_image(current_img_path)
-                load_succeeded = True
-            except PIL.UnidentifiedImageError:
+                return self.load_ultrasound_image(current_img_path)
+            except OSError:
+                # The file is incomplete (e.g. PIL.UnidentifiedImageError or a
+                # truncated image), wait until it is written again.
                 print("waiting for rgb file to finish streaming")
-                time.sleep(1)
+                existing_ok = False
 
-        return current_ultrasound_image
+    def get_frame_watcher(self, directory):
+        """Get the watcher for images streamed into a directory."""
+        if self._frame_watcher is None or self._frame_watcher.directory != directory:
+            if self._frame_watcher is not None:
+                self._frame_watcher.close()
+            self._frame_watcher = FrameWatcher(directory, method=self.frame_watch)
+        return self._frame_watcher
 
     def load_ultrasound_image(self, img_path):
         """Load RGB image and convert to grayscale.
@@ -163,6 +201,38 @@ class UltrasoundEnvironment(EmbodiedEnvironment):
         self.current_scene += 1
         self.step_count = 0
 
+    def get_scene_name(self):
+        """Get the name of the current scene.
+
+        After the last scene, the scenes are repeated from the start.
+        """
+        return self.scene_names[self.current_scene % len(self.scene_names)]
+
+    def get_num_steps(self):
+        """Get the number of steps of the current scene.
+
+        Returns:
+            int or None: The number of steps, None if it is not known up front
+                (without a dataset index).
+        """
+        if self.dataset_index is None:
+            return None
+        return self.dataset_index.get_num_steps(self.get_scene_name())
+
+    def seek(self, step):
+        """Continue the current scene at the given step.
+
+        The next call to step returns the observation of this step.
+
+        Raises:
+            IndexError: If the number of steps is known and the scene has no such
+                step.
+        """
+        num_steps = self.get_num_steps()
+        if step < 0 or (num_steps is not None and step >= num_steps):
+            raise IndexError(f"Scene {self.get_scene_name()!r} has no step {step}")
+        self.step_count = step
+
     def add_object(self, *args, **kwargs):
         raise NotImplementedError(
             "UltrasoundEnvironment does not support adding objects"
@@ -175,6 +245,17 @@ class UltrasoundEnvironment(EmbodiedEnvironment):
 
     def close(self):
         self._current_state = None
+        if self._frame_watcher is not None:
+            self._frame_watcher.close()
+            self._frame_watcher = None
+
+    def get_data_key(self):
+        """Get a key identifying the current observation in a recorded dataset.
+
+        Returns:
+            None, as live data can't be identified across runs.
+        """
+        return None
 
     def get_full_image(self):
         """Get the current full ultrasound image.
@@ -191,8 +272,30 @@ class UltrasoundEnvironment(EmbodiedEnvironment):
 
 
 class JSONDatasetUltrasoundEnvironment(UltrasoundEnvironment):
-    def __init__(self, data_path=None):
-        super().__init__(data_path)
+    def __init__(
+        self, data_path=None, use_feature_sidecar=False, use_dataset_index=False
+    ):
+        """Initialize environment.
+
+        Args:
+            data_path: path to the dataset directory containing the {step}.json
+                files.
+            use_feature_sidecar: If True, the patches, sensor module features and
+                poses are read from the feature sidecar of the dataset (created
+                with precompute_features.py) instead of the JSON files. The
+                observations then already contain the patch and no full image.
+                With a dataset index of several scenes, each scene directory
+                needs its own sidecar.
+            use_dataset_index: If True, the number of steps and the step files are
+                taken from the dataset index (created with index_dataset.py).
+        """
+        super().__init__(data_path, use_dataset_index=use_dataset_index)
+        self.use_feature_sidecar = use_feature_sidecar
+        self.feature_sidecar = None
+        self._feature_sidecar_path = None
+        if use_feature_sidecar:
+            # Fail early if the sidecar of the first scene is missing
+            self.get_feature_sidecar()
 
     def step(self, action: Action):
         """Retrieve the next observation.
@@ -213,16 +316,27 @@ class JSONDatasetUltrasoundEnvironment(UltrasoundEnvironment):
 
     def load_next_data_point(self):
         """Load the next ultrasound image from the dataset."""
+        if self.use_feature_sidecar:
+            return self.load_next_sidecar_data_point()
+        if self.dataset_index is not None:
+            if self.step_count >= self.get_num_steps():
+                # This will end the episode
+                return None, None
+            step_path = self.dataset_index.get_step_path(
+                self.get_scene_name(), self.step_count
+            )
+        else:
+            step_path = os.path.join(self.data_path, f"{self.step_count}.json")
         try:
-            with open(
-                os.path.join(self.data_path, f"{self.step_count}.json"), "r"
-            ) as f:
+            with open(step_path, "r") as f:
                 data = json.load(f)
         except FileNotFoundError:
             # This will end the episode
             return None, None
 
         self.full_image = np.array(data["obs"]["agent_id_0"]["ultrasound"]["img"])
+        # Pass on the array, so the image lists are only converted once
+        data["obs"]["agent_id_0"]["ultrasound"]["img"] = self.full_image
         # Overwrite the position of the probe.
         # TODO: can remove this now that it is added to the ProbeTriggeredUltrasoundEnvironment
         # (If used during data collection)
@@ -232,5 +346,148 @@ class JSONDatasetUltrasoundEnvironment(UltrasoundEnvironment):
         )
         return data["obs"], data["state"]
 
+    def get_num_steps(self):
+        if self.use_feature_sidecar:
+            return len(self.get_feature_sidecar())
+        return super().get_num_steps()
+
+    def get_scene_path(self):
+        """Get the directory with the {step}.json files of the current scene."""
+        if self.dataset_index is not None:
+            return self.dataset_index.get_scene_path(self.get_scene_name())
+        return self.data_path
+
+    def get_feature_sidecar(self):
+        """Get the (loaded) feature sidecar of the current scene."""
+        scene_path = os.path.abspath(self.get_scene_path())
+        if self._feature_sidecar_path != scene_path:
+            self.feature_sidecar = FeatureSidecar(scene_path)
+            self._feature_sidecar_path = scene_path
+        return self.feature_sidecar
+
+    def get_full_image(self):
+        """Get the current full ultrasound image.
+
+        Returns:
+            np.ndarray: The complete ultrasound image, or None with a feature
+                sidecar, which only stores the patches.
+        """
+        if self.use_feature_sidecar:
+            return None
+        return super().get_full_image()
+
+    def load_next_sidecar_data_point(self):
+        """Load the next patch observation and state from the feature sidecar."""
+        feature_sidecar = self.get_feature_sidecar()
+        if self.step_count >= len(feature_sidecar):
+            # This will end the episode
+            return None, None
+        obs = {
+            "agent_id_0": {
+                "patch": feature_sidecar.get_patch_observation(self.step_count)
+            }
+        }
+        return obs, feature_sidecar.get_state(self.step_count)
+
     def get_state(self):
         return self.current_state
+
+    def get_data_key(self):
+        """Get a key identifying the current observation in the dataset.
+
+        Returns:
+            tuple: (scene path, step) of the last loaded data point.
+        """
+        return (os.path.abspath(self.get_scene_path()), self.step_count - 1)
+
+
+class EpisodeFileUltrasoundEnvironment(UltrasoundEnvironment):
+    """Environment reading recorded episodes from binary episode files.
+
+    Each scene is one episode file (see custom_classes/episode_file.py), which
+    can be created from a JSON dataset with convert_json_dataset.py. The frames
+    are memory mapped, so an episode loads without parsing the whole recording.
+    With a dataset index, they are mapped at the byte offsets stored in the index,
+    so seeking to a step reads only its frame and record.
+    """
+
+    def __init__(self, data_path=None, use_dataset_index=False):
+        """Initialize environment.
+
+        Args:
+            data_path: path to a directory with episode files. They are used as
+                scenes in alphabetical order.
+            use_dataset_index: If True, the episode files are taken from the
+                dataset index (created with index_dataset.py).
+
+        Raises:
+            FileNotFoundError: If there are no episode files in data_path.
+        """
+        super().__init__(data_path, use_dataset_index=use_dataset_index)
+        self.scene_names = sorted(
+            name for name in self.scene_names if name.endswith(EPISODE_FILE_SUFFIX)
+        )
+        if not self.scene_names:
+            raise FileNotFoundError(f"No episode files found in {data_path}")
+        self.episode_file = None
+
+    def step(self, action: Action):
+        """Retrieve the next observation.
+
+        Args:
+            action: unused. We just load the next frame of the episode.
+
+        Returns:
+            observation (dict).
+        """
+        obs, self.current_state = self.load_next_data_point()
+        if obs is None:
+            return None
+        self.step_count += 1
+        return obs
+
+    def load_next_data_point(self):
+        """Load the next ultrasound image and state from the episode file."""
+        if self.step_count >= self.get_num_steps():
+            # This will end the episode
+            return None, None
+
+        episode_file = self.get_episode_file()
+        obs = episode_file.get_observation(self.step_count)
+        state = episode_file.get_state(self.step_count)
+        self.full_image = obs["agent_id_0"]["ultrasound"]["img"]
+        # Overwrite the position of the probe, as in JSONDatasetUltrasoundEnvironment
+        state["agent_id_0"]["sensors"]["ultrasound"]["position"] = np.array(
+            [0, 0.029, 0.084]
+        )
+        return obs, state
+
+    def get_episode_file(self):
+        """Get the (opened) episode file of the current scene."""
+        episode_path = self.get_episode_path()
+        if self.episode_file is None or self.episode_file.path != episode_path:
+            layout = None
+            if self.dataset_index is not None:
+                layout = self.dataset_index.get_episode_layout(self.get_scene_name())
+            self.episode_file = EpisodeFile(episode_path, layout=layout)
+        return self.episode_file
+
+    def get_episode_path(self):
+        """Get the path of the episode file of the current scene."""
+        return os.path.join(self.data_path, self.get_scene_name())
+
+    def get_num_steps(self):
+        if self.dataset_index is not None:
+            return super().get_num_steps()
+        return len(self.get_episode_file())
+
+    def get_state(self):
+        return self.current_state
+
+    def get_data_key(self):
+        """Get a key identifying the current observation in the dataset.
+
+        Returns:
+            tuple: (episode file path, step) of the last loaded data point.
+        """
+        return (os.path.abspath(self.get_episode_path()), self.step_count - 1)
@@ -0,0 +1,278 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Binary episode files holding all frames and poses of a recorded episode.
+
+An episode file contains, after a small JSON header, one contiguous uint8 array
+with the grayscale images of all steps and one structured array with a record of
+the step, capture time and poses of every step. Both arrays are read with
+np.memmap, so opening an episode is instant and only the frames that are used are
+read from disk. The free-form image metadata of each step is kept in the header.
+
+Layout:
+    8 bytes       magic, EPISODE_FILE_MAGIC
+    8 bytes       header length (little endian uint64)
+    header        UTF-8 JSON, see write_episode_file
+    padding       up to the next multiple of EPISODE_FILE_ALIGNMENT
+    images        uint8 array of shape (num_frames, height, width)
+    padding       up to the next multiple of EPISODE_FILE_ALIGNMENT
+    records       FRAME_RECORD_DTYPE array of shape (num_frames,)
+"""
+
+import json
+import os
+
+import numpy as np
+import quaternion as qt
+
+EPISODE_FILE_SUFFIX = ".episode"
+EPISODE_FILE_MAGIC = b"USEPISOD"
+EPISODE_FILE_VERSION = 1
+# Page aligned, so the arrays can be memory mapped efficiently
+EPISODE_FILE_ALIGNMENT = 4096
+
+FRAME_RECORD_DTYPE = np.dtype(
+    [
+        ("step", "<i8"),
+        # Time the image was captured (seconds since the epoch), NaN if unknown
+        ("epoch", "<f8"),
+        ("agent_position", "<f8", (3,)),
+        # Quaternions as [w, x, y, z]
+        ("agent_rotation", "<f8", (4,)),
+        ("sensor_position", "<f8", (3,)),
+        ("sensor_rotation", "<f8", (4,)),
+    ]
+)
+
+
+def write_episode_file(path, images, states, metadata=None):
+    """Write the frames and states of an episode to an episode file.
+
+    Args:
+        path: Path of the episode file.
+        images: Grayscale images of all steps, as an array of shape
+            (num_frames, height, width) or a list of equally sized images. Values
+            are rounded to uint8.
+        states: List with the agent state of each step (as returned by the
+            environment's get_state).
+        metadata: Optional list with the image metadata dict of each step.
+
+    Raises:
+        ValueError: If the images are not a stack of 2D images or the number of
+            images and states differ.
+    """
+    images = np.asarray(images)
+    if images.ndim != 3:
+        raise ValueError(
+            f"Expected images of shape (num_frames, height, width), got {images.shape}"
+        )
+    if images.dtype != np.uint8:
+        images = np.clip(np.rint(images), 0, 255).astype(np.uint8)
+    if len(images) != len(states):
+        raise ValueError(
+            f"Got {len(images)} images but {len(states)} states for {path}"
+        )
+    if metadata is None:
+        metadata = [{} for _ in states]
+
+    records = np.zeros(len(states), dtype=FRAME_RECORD_DTYPE)
+    for step, (state, step_metadata) in enumerate(zip(states, metadata)):
+        agent_state = state["agent_id_0"]
+        sensor_state = agent_state["sensors"]["ultrasound"]
+        records[step]["step"] = step
+        records[step]["epoch"] = step_metadata.get("epoch", np.nan)
+        records[step]["agent_position"] = agent_state["position"]
+        records[step]["agent_rotation"] = _rotation_as_array(agent_state["rotation"])
+        records[step]["sensor_position"] = sensor_state["position"]
+        records[step]["sensor_rotation"] = _rotation_as_array(sensor_state["rotation"])
+
+    num_frames, height, width = images.shape
+    header = {
+        "version": EPISODE_FILE_VERSION,
+        "num_frames": num_frames,
+        "height": height,
+        "width": width,
+        "metadata": metadata,
+    }
+    header_start = len(EPISODE_FILE_MAGIC) + 8
+    # The offsets depend on the header length and vice versa, so reserve enough
+    # digits for them up front.
+    header["images_offset"] = header["records_offset"] = 10**15
+    header_length = len(json.dumps(header).encode("utf-8"))
+    header["images_offset"] = _align(header_start + header_length)
+    header["records_offset"] = _align(header["images_offset"] + images.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8").ljust(header_length)
+
+    with open(path, "wb") as f:
+        f.write(EPISODE_FILE_MAGIC)
+        f.write(np.uint64(header_length).tobytes())
+        f.write(header_bytes)
+        f.seek(header["images_offset"])
+        f.write(np.ascontiguousarray(images).tobytes())
+        f.seek(header["records_offset"])
+        f.write(records.tobytes())
+
+
+class EpisodeFile:
+    """Memory mapped read access to an episode file."""
+
+    def __init__(self, path, layout=None):
+        """Open an episode file.
+
+        Args:
+            path: Path of the episode file.
+            layout: Optional dict with the "num_frames", "height", "width",
+                "images_offset" and "records_offset" of the file, e.g. from the
+                dataset index. The arrays are then mapped without reading the
+                header, which is only parsed when the metadata is first used.
+
+        Raises:
+            ValueError: If the file is not an episode file of a known version, or
+                its size doesn't match the layout.
+        """
+        self.path = path
+        self._metadata = None
+        if layout is None:
+            header = self._read_header()
+            self._metadata = header["metadata"]
+            layout = header
+        else:
+            expected_size = (
+                layout["records_offset"]
+                + layout["num_frames"] * FRAME_RECORD_DTYPE.itemsize
+            )
+            if layout["num_frames"] > 0 and os.path.getsize(path) != expected_size:
+                raise ValueError(
+                    f"{path} doesn't match its layout in the dataset index. "
+                    "Rebuild the index with index_dataset.py."
+                )
+
+        self.images_offset = layout["images_offset"]
+        self.records_offset = layout["records_offset"]
+        num_frames = layout["num_frames"]
+        # np.memmap can't map empty arrays
+        if num_frames == 0:
+            self.images = np.zeros((0, layout["height"], layout["width"]), np.uint8)
+            self.records = np.zeros(0, dtype=FRAME_RECORD_DTYPE)
+            return
+        self.images = np.memmap(
+            path,
+            dtype=np.uint8,
+            mode="r",
+            offset=self.images_offset,
+            shape=(num_frames, layout["height"], layout["width"]),
+        )
+        self.records = np.memmap(
+            path,
+            dtype=FRAME_RECORD_DTYPE,
+            mode="r",
+            offset=self.records_offset,
+            shape=(num_frames,),
+        )
+
+    @property
+    def metadata(self):
+        """The image metadata of every step, read from the header on first use."""
+        if self._metadata is None:
+            self._metadata = self._read_header()["metadata"]
+        return self._metadata
+
+    def _read_header(self):
+        with open(self.path, "rb") as f:
+            magic = f.read(len(EPISODE_FILE_MAGIC))
+            if magic != EPISODE_FILE_MAGIC:
+                raise ValueError(f"{self.path} is not an episode file")
+            header_length = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            header = json.loads(f.read(header_length).decode("utf-8"))
+        if header["version"] != EPISODE_FILE_VERSION:
+            raise ValueError(
+                f"Unsupported episode file version {header['version']} of "
+                f"{self.path}"
+            )
+        return header
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_observation(self, step):
+        """Get the observation of a step, in the format of the recorded JSON files.
+
+        The image is a read-only uint8 view into the memory mapped file, so no
+        pixels are copied. Only the parts that are accessed are read from disk.
+        """
+        metadata = dict(self.metadata[step])
+        return {
+            "agent_id_0": {
+                "ultrasound": {
+                    "img": self.images[step],
+                    "metadata": metadata,
+                },
+            }
+        }
+
+    def get_state(self, step):
+        """Get the agent state of a step."""
+        record = self.records[step]
+        return {
+            "agent_id_0": {
+                "sensors": {
+                    "ultrasound": {
+                        "rotation": qt.from_float_array(record["sensor_rotation"]),
+                        "position": np.array(record["sensor_position"]),
+                    },
+                },
+                "rotation": qt.from_float_array(record["agent_rotation"]),
+                "position": np.array(record["agent_position"]),
+            }
+        }
+
+
+def convert_json_dataset(data_path, episode_path=None):
+    """Convert a JSON dataset directory into an episode file.
+
+    Args:
+        data_path: Dataset directory containing the {step}.json files.
+        episode_path: Path of the episode file. Defaults to the dataset directory
+            name with EPISODE_FILE_SUFFIX, next to the dataset directory.
+
+    Returns:
+        str: Path of the written episode file.
+
+    Raises:
+        ValueError: If the dataset contains no data points.
+    """
+    if episode_path is None:
+        episode_path = os.path.normpath(data_path) + EPISODE_FILE_SUFFIX
+
+    images, states, metadata = [], [], []
+    step = 0
+    while os.path.exists(os.path.join(data_path, f"{step}.json")):
+        with open(os.path.join(data_path, f"{step}.json"), "r") as f:
+            data = json.load(f)
+        ultrasound_obs = data["obs"]["agent_id_0"]["ultrasound"]
+        images.append(np.clip(np.rint(ultrasound_obs["img"]), 0, 255).astype(np.uint8))
+        metadata.append(ultrasound_obs.get("metadata", {}))
+        states.append(data["state"])
+        step += 1
+    if not images:
+        raise ValueError(f"No data points found in {data_path}")
+
+    write_episode_file(episode_path, images, states, metadata)
+    return episode_path
+
+
+def _align(offset):
+    return -(-offset // EPISODE_FILE_ALIGNMENT) * EPISODE_FILE_ALIGNMENT
+
+
+def _rotation_as_array(rotation):
+    # Rotations are quaternions or [w, x, y, z] lists (after a JSON round trip)
+    if isinstance(rotation, qt.quaternion):
+        return qt.as_float_array(rotation)
+    return np.asarray(rotation, dtype=float)
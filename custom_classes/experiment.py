@@ -97,7 +97,7 @@ class UltrasoundExperiment(MontyObjectRecognitionExperiment):
 
                 # Plot based on config
                 if self.plotting_config.get("plot_patch_features", False):
-                    full_image = self.dataloader.dataset.env.get_full_image()
+                    full_image = self.dataloader.get_full_image()
 
                     plot_combined_figure(
                         input_image=full_image,
@@ -0,0 +1,370 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Stand-ins for the iPad app and the Vive tracker server, for load testing.
+
+A FrameSource provides the images and poses to replay, either from a recorded
+dataset (RecordedFrameSource) or generated (SyntheticFrameSource). The
+FramePoster sends the images to the /capture endpoint of the ImageServer at a
+fixed rate, like the iPad app, and registers the pose of every sent image with a
+FakeTrackerServer. That serves them on /pose like scripts/htc_vive/server.py, so
+ProbeTriggeredUltrasoundEnvironment gets the recorded pose of each image. The
+tracker server also records when the pose of each image was first requested,
+which is when the environment took the image from the queue.
+"""
+
+import bisect
+import io
+import json
+import os
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import quaternion as qt
+import requests
+from PIL import Image
+
+from custom_classes.episode_file import EPISODE_FILE_SUFFIX, EpisodeFile
+from custom_classes.server import encode_raw_frame
+
+FRAME_FORMATS = ("png", "raw")
+
+
+class FrameSource:
+    """Images and tracker poses to replay."""
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def get_frame(self, index):
+        """Get an image and the pose of the tracker when it was taken.
+
+        Returns:
+            tuple: (image, pose). The (height, width) uint8 image and the pose in
+                the format of the "pose" of a /pose response.
+        """
+        raise NotImplementedError
+
+
+class RecordedFrameSource(FrameSource):
+    """Frames of a recorded JSON dataset directory or episode file."""
+
+    def __init__(self, data_path):
+        """Load the frames of a dataset.
+
+        Args:
+            data_path: Directory with {step}.json files, or an episode file.
+
+        Raises:
+            ValueError: If the dataset contains no frames.
+        """
+        if data_path.endswith(EPISODE_FILE_SUFFIX) and os.path.isfile(data_path):
+            episode_file = EpisodeFile(data_path)
+            self.images = episode_file.images
+            self.positions = np.array(episode_file.records["agent_position"])
+            self.rotations = np.array(episode_file.records["agent_rotation"])
+        else:
+            images, positions, rotations = [], [], []
+            while os.path.exists(os.path.join(data_path, f"{len(images)}.json")):
+                with open(os.path.join(data_path, f"{len(images)}.json"), "r") as f:
+                    data = json.load(f)
+                image = data["obs"]["agent_id_0"]["ultrasound"]["img"]
+                images.append(np.clip(np.rint(image), 0, 255).astype(np.uint8))
+                agent_state = data["state"]["agent_id_0"]
+                positions.append(agent_state["position"])
+                # [w, x, y, z] lists after the JSON round trip
+                rotations.append(agent_state["rotation"])
+            self.images = images
+            self.positions = np.asarray(positions, dtype=float)
+            self.rotations = np.asarray(rotations, dtype=float)
+        if len(self.images) == 0:
+            raise ValueError(f"No frames found in {data_path}")
+
+    def __len__(self):
+        return len(self.images)
+
+    def get_frame(self, index):
+        return np.asarray(self.images[index]), _to_pose(
+            self.positions[index], self.rotations[index]
+        )
+
+
+class SyntheticFrameSource(FrameSource):
+    """Random images, with the tracker moving along a straight line."""
+
+    def __init__(self, num_frames=100, image_shape=(480, 640), seed=0):
+        rng = np.random.default_rng(seed)
+        self.images = rng.integers(
+            0, 256, size=(num_frames,) + tuple(image_shape), dtype=np.uint8
+        )
+        self.positions = np.zeros((num_frames, 3))
+        self.positions[:, 0] = np.linspace(0.0, 0.1, num_frames)
+
+    def __len__(self):
+        return len(self.images)
+
+    def get_frame(self, index):
+        return self.images[index], _to_pose(self.positions[index], [1.0, 0, 0, 0])
+
+
+class FakeTrackerServer:
+    """Serves the poses of the sent frames like the Vive tracker server.
+
+    /pose?epoch=<time> returns the pose of the last frame sent at or before that
+    time, /pose without an epoch the pose of the last sent frame. /stats returns
+    the current "time", which is on the clock of this computer.
+    """
+
+    def __init__(self, port=3001, serial_number="FAKE-TRACKER"):
+        self.port = port
+        self.serial_number = serial_number
+        self._lock = threading.Lock()
+        self._send_times = []
+        self._poses = []
+        # Time the pose of each frame was first requested, by frame number
+        self._pickup_times = {}
+        self._httpd = None
+        self._thread = None
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer(("0.0.0.0", self.port), _PoseRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.tracker = self
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, name="FakeTrackerServer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def add_frame(self, send_time, pose):
+        """Register the pose of a frame that is sent at send_time.
+
+        Frames must be added in the order they are sent.
+
+        Returns:
+            int: Number of the frame.
+        """
+        with self._lock:
+            self._send_times.append(send_time)
+            self._poses.append(pose)
+            return len(self._poses) - 1
+
+    def get_pickup_times(self):
+        with self._lock:
+            return dict(self._pickup_times)
+
+    def get_pose_response(self, epoch=None):
+        """Get the status and payload of a /pose request."""
+        now = time.time()
+        with self._lock:
+            if epoch is None:
+                frame = len(self._poses) - 1
+            else:
+                frame = bisect.bisect_right(self._send_times, epoch) - 1
+            if frame < 0:
+                return 404, {"error": "Tracker pose not available or invalid"}
+            if epoch is not None:
+                self._pickup_times.setdefault(frame, now)
+            return 200, {
+                "data": {
+                    "timestamp": self._send_times[frame],
+                    "pose": self._poses[frame],
+                    "interpolated": False,
+                    "serial_number": self.serial_number,
+                }
+            }
+
+
+class _PoseRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive like the tracker server
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        parsed_path = urllib.parse.urlparse(self.path)
+        if parsed_path.path == "/stats":
+            self._send_json(200, {"time": time.time()})
+            return
+        if parsed_path.path != "/pose":
+            self._send_json(404, {"error": "Not Found"})
+            return
+        query_params = urllib.parse.parse_qs(parsed_path.query)
+        epoch = query_params.get("epoch", [None])[0]
+        try:
+            epoch = None if epoch is None else float(epoch)
+        except ValueError:
+            self._send_json(400, {"error": f"Invalid epoch: {epoch}"})
+            return
+        self._send_json(*self.server.tracker.get_pose_response(epoch))
+
+    def log_message(self, format, *args):
+        # One line per request would slow down the load test
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FramePoster:
+    """Sends the frames of a FrameSource to the ImageServer at a fixed rate."""
+
+    def __init__(
+        self,
+        frame_source,
+        capture_url="http://localhost:3000/capture",
+        tracker=None,
+        rate=10.0,
+        frame_format="png",
+    ):
+        """Initialize the poster.
+
+        Args:
+            frame_source: The FrameSource to send, repeated when it runs out.
+            capture_url: URL of the /capture endpoint. With frame_format "raw",
+                the frames are sent to /capture_raw next to it.
+            tracker: FakeTrackerServer to register the pose of every frame with.
+            rate: Frames per second. Frames are sent one at a time, so if a
+                request takes longer than 1 / rate seconds the rate drops.
+            frame_format: "png" to send PNG files like the iPad app, "raw" for
+                uncompressed frames (see encode_raw_frame).
+
+        Raises:
+            ValueError: If rate is not positive or frame_format is unknown.
+        """
+        if not rate > 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        if frame_format not in FRAME_FORMATS:
+            raise ValueError(
+                f"Unknown frame format: {frame_format}. Must be one of {FRAME_FORMATS}"
+            )
+        self.frame_source = frame_source
+        if frame_format == "raw":
+            capture_url = capture_url.rsplit("/", 1)[0] + "/capture_raw"
+        self.capture_url = capture_url
+        self.tracker = tracker
+        self.period = 1.0 / rate
+        self.frame_format = frame_format
+        self._session = requests.Session()
+        # PNG files of the source frames, so encoding doesn't limit the rate
+        self._encoded = {}
+
+    def run(self, duration=None, num_frames=None, stop_event=None):
+        """Send frames until duration seconds passed or num_frames were sent.
+
+        Returns:
+            list: Per frame, a dict with its "send_time", request "latency" in
+                seconds and capture "status" ("success", "dropped", "rejected"
+                or "error").
+        """
+        results = []
+        start_time = time.monotonic()
+        next_time = start_time
+        while num_frames is None or len(results) < num_frames:
+            if duration is not None and next_time - start_time >= duration:
+                break
+            if stop_event is not None and stop_event.is_set():
+                break
+            remaining = next_time - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            results.append(self._send(len(results)))
+            # If sending took too long, continue right away but don't catch up
+            next_time = max(next_time + self.period, time.monotonic())
+        return results
+
+    def close(self):
+        self._session.close()
+
+    def _send(self, step):
+        index = step % len(self.frame_source)
+        image, pose = self.frame_source.get_frame(index)
+        if self.frame_format == "png" and index not in self._encoded:
+            buffer = io.BytesIO()
+            Image.fromarray(image).save(buffer, format="PNG")
+            self._encoded[index] = buffer.getvalue()
+        headers = {
+            "X-Metadata": json.dumps({"step": step}),
+            "X-Metadata-Content-Type": "application/json",
+        }
+
+        send_time = time.time()
+        if self.tracker is not None:
+            self.tracker.add_frame(send_time, pose)
+        start = time.perf_counter()
+        try:
+            if self.frame_format == "png":
+                response = self._session.post(
+                    self.capture_url,
+                    files={"file": ("frame.png", self._encoded[index], "image/png")},
+                    headers=headers,
+                    timeout=10.0,
+                )
+            else:
+                response = self._session.post(
+                    self.capture_url,
+                    data=encode_raw_frame(image, epoch=send_time, step=step),
+                    headers=headers,
+                    timeout=10.0,
+                )
+            if response.status_code == 429:
+                status = "rejected"
+            elif response.ok:
+                status = response.json().get("status", "error")
+            else:
+                status = "error"
+        except requests.RequestException:
+            status = "error"
+        latency = time.perf_counter() - start
+        return {"send_time": send_time, "latency": latency, "status": status}
+
+
+def summarize_latencies(latencies):
+    """Get the mean and percentiles of latencies, in milliseconds."""
+    if len(latencies) == 0:
+        return {"count": 0}
+    latencies_ms = np.asarray(latencies) * 1000.0
+    p50, p90, p99 = np.percentile(latencies_ms, [50, 90, 99])
+    return {
+        "count": len(latencies_ms),
+        "mean": float(np.mean(latencies_ms)),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(np.max(latencies_ms)),
+    }
+
+
+def _to_pose(position, rotation):
+    rotation = qt.from_float_array(rotation)
+    return {
+        "position": {
+            "x": float(position[0]),
+            "y": float(position[1]),
+            "z": float(position[2]),
+        },
+        "rotation": {
+            "w": float(rotation.w),
+            "x": float(rotation.x),
+            "y": float(rotation.y),
+            "z": float(rotation.z),
+        },
+    }
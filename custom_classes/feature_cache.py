@@ -0,0 +1,103 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""On-disk cache of the patch features extracted by the UltrasoundSM."""
+
+import atexit
+import hashlib
+import os
+
+import numpy as np
+
+
+class PatchFeatureCache:
+    """Caches normals, curvatures and pixel depths keyed by dataset path and step.
+
+    The features of one dataset are stored in one .npz file in cache_dir. The file
+    name is derived from the absolute dataset path and a settings key, so that
+    features extracted with different sensor module settings are kept apart. Files
+    are loaded on first access and new entries are written back on flush (and at
+    exit).
+    """
+
+    def __init__(self, cache_dir, settings_key=""):
+        """Initialize the cache.
+
+        Args:
+            cache_dir: Directory the cache files are stored in.
+            settings_key: String describing the settings the features depend on.
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.settings_key = settings_key
+        self._entries = {}
+        self._dirty = set()
+
+        atexit.register(self.flush)
+
+    def get(self, dataset_path, step):
+        """Return the cached (normal, curvature, pixel_depth) or None if missing."""
+        return self._load(dataset_path).get(step)
+
+    def put(self, dataset_path, step, normal, curvature, pixel_depth):
+        """Add the features of one step. They are written to disk on flush."""
+        self._load(dataset_path)[step] = (
+            np.asarray(normal, dtype=float),
+            float(curvature),
+            float(pixel_depth),
+        )
+        self._dirty.add(self._file_path(dataset_path))
+
+    def put_batch(self, dataset_path, steps, normals, curvatures, pixel_depths):
+        """Add the features of several steps, e.g. from extract_patch_pose_feat_batch."""
+        for step, normal, curvature, pixel_depth in zip(
+            steps, normals, curvatures, pixel_depths
+        ):
+            self.put(dataset_path, int(step), normal, curvature, pixel_depth)
+
+    def flush(self):
+        """Write all datasets with new entries to disk."""
+        if not self._dirty:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for file_path in self._dirty:
+            entries = self._entries[file_path]
+            steps = np.array(sorted(entries), dtype=np.int64)
+            np.savez(
+                file_path,
+                steps=steps,
+                normals=np.array([entries[s][0] for s in steps]).reshape(-1, 3),
+                curvatures=np.array([entries[s][1] for s in steps]),
+                pixel_depths=np.array([entries[s][2] for s in steps]),
+            )
+        self._dirty = set()
+
+    def _file_path(self, dataset_path):
+        key = f"{os.path.abspath(dataset_path)}|{self.settings_key}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{digest}.npz")
+
+    def _load(self, dataset_path):
+        file_path = self._file_path(dataset_path)
+        if file_path not in self._entries:
+            entries = {}
+            if os.path.exists(file_path):
+                with np.load(file_path) as data:
+                    for step, normal, curvature, pixel_depth in zip(
+                        data["steps"],
+                        data["normals"],
+                        data["curvatures"],
+                        data["pixel_depths"],
+                    ):
+                        entries[int(step)] = (
+                            normal,
+                            float(curvature),
+                            float(pixel_depth),
+                        )
+            self._entries[file_path] = entries
+        return self._entries[file_path]
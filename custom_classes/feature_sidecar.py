@@ -0,0 +1,193 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Precomputed patches, features and poses stored next to a JSON dataset.
+
+The sidecar is written once per dataset by precompute_features.py and read by the
+JSONDatasetUltrasoundEnvironment with use_feature_sidecar=True, which then skips
+parsing the JSON files, the patch search and the circle fits.
+"""
+
+import os
+
+import numpy as np
+import quaternion as qt
+
+SIDECAR_FILE_NAME = "features.npz"
+SIDECAR_FORMAT_VERSION = 1
+
+
+def get_sidecar_path(data_path):
+    """Get the path of the feature sidecar of a dataset directory."""
+    return os.path.join(data_path, SIDECAR_FILE_NAME)
+
+
+def save_feature_sidecar(
+    data_path,
+    patch_size,
+    settings_key,
+    patches,
+    patch_pixel_starts,
+    full_image_heights,
+    features,
+    states,
+):
+    """Write the feature sidecar of a dataset.
+
+    Args:
+        data_path: Dataset directory the sidecar is written to.
+        patch_size: Patch size used for the patch search.
+        settings_key: Sensor module settings the features were extracted with, see
+            UltrasoundSM.get_feature_settings_key.
+        patches: Stack of patches of shape (N, patch_size, patch_size). They are
+            stored as float32 if that is lossless and in their own dtype otherwise.
+        patch_pixel_starts: y pixel coordinate of the start of each patch.
+        full_image_heights: Height of each full ultrasound image.
+        features: Dict with the arrays normals, curvatures, pixel_depths,
+            edge_rows, center_edge_points and fitted_circles, as returned by
+            UltrasoundSM.extract_patch_pose_feat_batch with return_fit_details.
+        states: List of the agent states of each step (as returned by the
+            environment's get_state).
+
+    Returns:
+        str: Path of the written sidecar.
+    """
+    patches = np.asarray(patches)
+    if np.array_equal(patches.astype(np.float32), patches):
+        patches = patches.astype(np.float32)
+
+    agent_states = [state["agent_id_0"] for state in states]
+    sensor_states = [state["sensors"]["ultrasound"] for state in agent_states]
+
+    sidecar_path = get_sidecar_path(data_path)
+    np.savez_compressed(
+        sidecar_path,
+        format_version=SIDECAR_FORMAT_VERSION,
+        patch_size=patch_size,
+        settings_key=settings_key,
+        patches=patches,
+        patch_pixel_starts=np.asarray(patch_pixel_starts, dtype=np.int64),
+        full_image_heights=np.asarray(full_image_heights, dtype=np.int64),
+        normals=features["normals"],
+        curvatures=features["curvatures"],
+        pixel_depths=features["pixel_depths"],
+        # Row of the edge in every patch column, -1 if the column has no edge
+        edge_rows=np.where(features["has_edge"], features["edge_rows"], -1).astype(
+            np.int16
+        ),
+        center_edge_points=features["center_edge_points"],
+        # NaN for patches where the points were fitted with a line
+        fitted_circles=features["fitted_circles"],
+        agent_positions=_stack_positions(agent_states),
+        agent_rotations=_stack_rotations(agent_states),
+        sensor_positions=_stack_positions(sensor_states),
+        sensor_rotations=_stack_rotations(sensor_states),
+    )
+    return sidecar_path
+
+
+class FeatureSidecar:
+    """Read access to the feature sidecar of a dataset.
+
+    All arrays are loaded into memory when the sidecar is opened.
+    """
+
+    def __init__(self, data_path):
+        """Load the sidecar of a dataset.
+
+        Args:
+            data_path: Dataset directory containing the sidecar.
+
+        Raises:
+            FileNotFoundError: If the dataset has no sidecar.
+            ValueError: If the sidecar was written in an unknown format.
+        """
+        sidecar_path = get_sidecar_path(data_path)
+        if not os.path.exists(sidecar_path):
+            raise FileNotFoundError(
+                f"No feature sidecar found at {sidecar_path}. "
+                "Create it with precompute_features.py."
+            )
+        with np.load(sidecar_path) as data:
+            arrays = {key: data[key] for key in data.files}
+        if int(arrays["format_version"]) != SIDECAR_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported feature sidecar version {arrays['format_version']}"
+            )
+        self.patch_size = int(arrays.pop("patch_size"))
+        self.settings_key = str(arrays.pop("settings_key"))
+        self._arrays = arrays
+
+    def __len__(self):
+        return len(self._arrays["patches"])
+
+    def get_patch_observation(self, step):
+        """Get the patch observation of a step, as created by the dataloader.
+
+        Returns:
+            dict: The patch observation. Its "features" entry holds the
+                precomputed sensor module features.
+        """
+        a = self._arrays
+        edge_rows = a["edge_rows"][step]
+        edge_columns = np.flatnonzero(edge_rows >= 0)
+        fitted_circle = a["fitted_circles"][step]
+        return {
+            "img": a["patches"][step],
+            "patch_pixel_start": int(a["patch_pixel_starts"][step]),
+            "full_image_height": int(a["full_image_heights"][step]),
+            "features": {
+                "settings_key": self.settings_key,
+                "normal": a["normals"][step],
+                "curvature": float(a["curvatures"][step]),
+                "pixel_depth": float(a["pixel_depths"][step]),
+                "column_points": list(
+                    zip(
+                        edge_columns.astype(float).tolist(),
+                        edge_rows[edge_columns].astype(float).tolist(),
+                    )
+                ),
+                "center_edge": tuple(a["center_edge_points"][step].tolist()),
+                "fitted_circle": None
+                if np.isnan(fitted_circle).any()
+                else tuple(fitted_circle.tolist()),
+            },
+        }
+
+    def get_state(self, step):
+        """Get the agent state of a step, as returned by the environment."""
+        a = self._arrays
+        return {
+            "agent_id_0": {
+                "sensors": {
+                    "ultrasound": {
+                        "rotation": qt.from_float_array(a["sensor_rotations"][step]),
+                        "position": a["sensor_positions"][step],
+                    },
+                },
+                "rotation": qt.from_float_array(a["agent_rotations"][step]),
+                "position": a["agent_positions"][step],
+            }
+        }
+
+
+def _stack_positions(states):
+    return np.array([np.asarray(s["position"], dtype=float) for s in states])
+
+
+def _stack_rotations(states):
+    # Rotations are quaternions or [w, x, y, z] lists (after a JSON round trip)
+    return np.array(
+        [
+            qt.as_float_array(s["rotation"])
+            if isinstance(s["rotation"], qt.quaternion)
+            else np.asarray(s["rotation"], dtype=float)
+            for s in states
+        ]
+    ).reshape(-1, 4)
@@ -0,0 +1,159 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Wait for frames that are streamed into a directory as files.
+
+On Linux, the FrameWatcher uses inotify (through ctypes, no extra dependency) and
+wakes up as soon as a file is closed after writing or moved into the directory.
+Elsewhere it falls back to polling the file system at a short interval.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_inotify_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    library = ctypes.util.find_library("c")
+    if library is None:
+        return None
+    libc = ctypes.CDLL(library, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    return libc
+
+
+class FrameWatcher:
+    """Waits for files to be completely written into one directory."""
+
+    def __init__(self, directory, method="auto", poll_interval=0.05):
+        """Initialize the watcher.
+
+        Args:
+            directory: Directory the frames are written to.
+            method: "inotify" to wait for file system events, "polling" to check
+                for the file every poll_interval seconds, "auto" to use inotify if
+                it is available and the directory can be watched.
+            poll_interval: Seconds between checks when polling.
+
+        Raises:
+            ValueError: If method is unknown.
+            OSError: If method is "inotify" and inotify is not available or the
+                directory can't be watched.
+        """
+        if method not in ("auto", "inotify", "polling"):
+            raise ValueError(f"Unknown frame watch method: {method}")
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self._fd = None
+
+        libc = _load_inotify_libc() if method != "polling" else None
+        if libc is None:
+            if method == "inotify":
+                raise OSError("inotify is not available on this system")
+            self.method = "polling"
+            return
+
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        watch = libc.inotify_add_watch(
+            fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO
+        )
+        if watch < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            if method == "inotify":
+                raise OSError(errno, f"Can't watch {directory}")
+            # E.g. the directory doesn't exist (yet)
+            self.method = "polling"
+            return
+        self._fd = fd
+        self.method = "inotify"
+
+    def wait_for_file(self, file_name, timeout=None, existing_ok=True):
+        """Wait until a file in the directory is completely written.
+
+        Args:
+            file_name: Name of the file in the directory.
+            timeout: Maximum number of seconds to wait, None to wait forever.
+            existing_ok: If True, return right away if the file already exists.
+                It may still be being written though. If False, wait for the
+                next time it is completed, e.g. after failing to read it.
+
+        Returns:
+            bool: True if the file is ready, False on timeout.
+        """
+        path = os.path.join(self.directory, file_name)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self._fd is None:
+            return self._poll_for_file(path, deadline, existing_ok)
+
+        # Events queued before a failed read may be from the same write. Then the
+        # caller simply fails once more and waits again.
+        while True:
+            # The watch is active, so if the file exists now any later write
+            # still produces an event. Events of files completed before they are
+            # waited for are not kept, the file then exists already.
+            if existing_ok and os.path.exists(path):
+                return True
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            if self._read_events(file_name, timeout=remaining):
+                return True
+            # Only check for the file once, after that rely on the events
+            existing_ok = False
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _poll_for_file(self, path, deadline, existing_ok):
+        if not existing_ok:
+            # We can't tell when a write has finished, so give it some time
+            time.sleep(self.poll_interval)
+        while not os.path.exists(path):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def _read_events(self, file_name, timeout):
+        """Read the pending events, waiting up to timeout seconds for one.
+
+        Returns:
+            bool: True if one of the events completed file_name.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+        buffer = os.read(self._fd, 64 * 1024)
+        completed = False
+        offset = 0
+        while offset < len(buffer):
+            _, _, _, name_length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset : offset + name_length].rstrip(b"\0")
+            offset += name_length
+            completed = completed or os.fsdecode(name) == file_name
+        return completed
@@ -0,0 +1,218 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Search for the patch with the strongest horizontal edge in an image."""
+
+import numpy as np
+
+
+def find_patch_with_highest_gradient(
+    full_image,
+    patch_size,
+    grid_size=9,
+    patch_search="vectorized",
+):
+    """Finds the patch with the strongest horizontal edge in the ultrasound image.
+
+    Takes a patch at the center top of the image and shifts it down in the middle
+    column. Each time it calculates the horizontal edges using a Sobel filter on a
+    9x9 grid of mean intensities on a 0.5 sized patch. At the center location of
+    the patch with the maximum gradient it extracts a patch of size
+    patch_size x patch_size.
+
+    Args:
+        full_image (np.ndarray): The full ultrasound image of shape (N, M)
+        patch_size (int): Size of the square patch to extract
+        grid_size (int): Number of bins to group the pixel values into along each
+            dimension of the patch for calculating the mean intensity.
+        patch_search (str): "vectorized" to use compute_gradient_profile, "loop"
+            to use compute_gradient_profile_loop.
+    Returns:
+        tuple: (patch, patch_pixel_start) where:
+            - patch (np.ndarray): The patch with the strongest horizontal edge
+            - patch_pixel_start (int): the y pixel coordinate of start of the
+                patch; e.g. if the image is 200x800 pixels, this might be
+                pixel 240
+    """
+    width = full_image.shape[1]
+    x_center = width // 2
+
+    # Collect all gradients by moving the patch down the center column
+    # Use a smaller patch for this
+    test_patch_size = patch_size // 2
+    if patch_search == "vectorized":
+        y_central_positions, gradients = compute_gradient_profile(
+            full_image, patch_size, grid_size
+        )
+    else:
+        y_central_positions, gradients = compute_gradient_profile_loop(
+            full_image, patch_size, grid_size
+        )
+    # Note we use the initial y position of the patch for the depth,
+    # as later we will determine the location of the edge within the patch for
+    # the final depth reading
+    y_starting_positions = y_central_positions - test_patch_size // 2
+
+    # Use the maximum gradient
+    max_idx = np.argmax(gradients)
+    best_central_location = (y_central_positions[max_idx], x_center)
+    best_starting_location = (y_starting_positions[max_idx], x_center)
+
+    # Extract the final patch at the selected location
+    y, x = best_central_location
+    best_patch = full_image[
+        y - patch_size // 2 : y + patch_size // 2,
+        x - patch_size // 2 : x + patch_size // 2,
+    ]
+
+    y_start = best_starting_location[0]
+    return best_patch, y_start
+
+
+def compute_gradient_profile(full_image, patch_size, grid_size):
+    """Computes the horizontal edge response for all rows of the center column.
+
+    Vectorized version of compute_gradient_profile_loop. The cell means for every
+    row position are read from a summed-area table over the center column bands
+    and the Sobel filter is applied to all positions at once. The gradients agree
+    with the loop version up to floating point rounding, so the selected patch is
+    the same unless several rows have mathematically identical gradients.
+
+    Args:
+        full_image (np.ndarray): The full ultrasound image of shape (N, M)
+        patch_size (int): Size of the final patch. A patch of half this size is
+            moved down the center column.
+        grid_size (int): Number of cells along each dimension of the test patch.
+
+    Returns:
+        tuple: (y_central_positions, gradients) where:
+            - y_central_positions (np.ndarray): y pixel coordinate of the patch
+                center for each tested row.
+            - gradients (np.ndarray): total horizontal edge response of the
+                patch centered at each of these rows.
+    """
+    height, width = full_image.shape
+    x_center = width // 2
+    test_patch_size = patch_size // 2
+    half_test_size = test_patch_size // 2
+    cell_size = test_patch_size // grid_size
+
+    y_central_positions = np.arange(patch_size // 2, height - patch_size // 2)
+    num_positions = len(y_central_positions)
+    # Image row of the top of the first grid cell for the first position
+    first_row = y_central_positions[0] - half_test_size if num_positions else 0
+
+    # Sum each image row over the column band of every grid cell and accumulate
+    # these down the rows (summed-area table). The mean of a cell starting at
+    # any row is then the difference of two entries.
+    x_start = x_center - half_test_size
+    band_sums = np.add.reduceat(
+        full_image[:, x_start : x_start + grid_size * cell_size],
+        np.arange(grid_size) * cell_size,
+        axis=1,
+        dtype=np.float64,
+    )
+    summed_area = np.zeros((height + 1, grid_size))
+    np.cumsum(band_sums, axis=0, out=summed_area[1:])
+    cell_means = (summed_area[cell_size:] - summed_area[:-cell_size]) / (
+        cell_size * cell_size
+    )
+
+    # The Sobel filter [[-1, -2, -1], [0, 0, 0], [1, 2, 1]] is separable.
+    # Smooth across the cells of each row first (edge padded)...
+    smoothed = np.empty_like(cell_means)
+    smoothed[:, 1:-1] = cell_means[:, :-2] + 2 * cell_means[:, 1:-1] + cell_means[:, 2:]
+    smoothed[:, 0] = 3 * cell_means[:, 0] + cell_means[:, 1]
+    smoothed[:, -1] = cell_means[:, -2] + 3 * cell_means[:, -1]
+
+    # ...then take the difference between the cell rows below and above. With
+    # edge padding the first and last cell row compare neighbours one cell
+    # apart, all other cell rows compare neighbours two cells apart.
+    one_cell_diff = np.sum(np.abs(smoothed[cell_size:] - smoothed[:-cell_size]), axis=1)
+    two_cell_diff = np.sum(
+        np.abs(smoothed[2 * cell_size :] - smoothed[: -2 * cell_size]), axis=1
+    )
+
+    last_offset = first_row + (grid_size - 2) * cell_size
+    gradients = (
+        one_cell_diff[first_row : first_row + num_positions]
+        + one_cell_diff[last_offset : last_offset + num_positions]
+    )
+    for i in range(1, grid_size - 1):
+        offset = first_row + (i - 1) * cell_size
+        gradients += two_cell_diff[offset : offset + num_positions]
+
+    return y_central_positions, gradients
+
+
+def compute_gradient_profile_loop(full_image, patch_size, grid_size):
+    """Computes the horizontal edge response row by row down the center column.
+
+    For each row a patch of half the patch_size is extracted, the mean
+    intensities of a grid_size x grid_size grid of cells are calculated and the
+    horizontal edges are detected with a Sobel filter on these means.
+
+    Args:
+        full_image (np.ndarray): The full ultrasound image of shape (N, M)
+        patch_size (int): Size of the final patch. A patch of half this size is
+            moved down the center column.
+        grid_size (int): Number of cells along each dimension of the test patch.
+
+    Returns:
+        tuple: (y_central_positions, gradients), see compute_gradient_profile.
+    """
+    height, width = full_image.shape
+    x_center = width // 2
+    test_patch_size = patch_size // 2
+    start_y = patch_size // 2
+
+    y_central_positions = []
+    gradients = []
+
+    # Define Sobel kernel for horizontal edge detection
+    # TODO: check this is the best kernel for what we want
+    sobel_horizontal = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]])
+
+    for y in range(start_y, height - patch_size // 2):
+        # Extract patch
+        patch = full_image[
+            y - test_patch_size // 2 : y + test_patch_size // 2,
+            x_center - test_patch_size // 2 : x_center + test_patch_size // 2,
+        ]
+
+        cell_size = test_patch_size // grid_size
+        # Compute mean intensity for each cell
+        cell_means = np.zeros((grid_size, grid_size))
+        for i in range(grid_size):
+            for j in range(grid_size):
+                cell = patch[
+                    i * cell_size : (i + 1) * cell_size,
+                    j * cell_size : (j + 1) * cell_size,
+                ]
+                cell_means[i, j] = np.mean(cell)
+
+        # Pad the cell_means for Sobel filtering
+        padded_means = np.pad(cell_means, 1, mode="edge")
+
+        # Apply Sobel filter to detect horizontal edges
+        edge_response = np.zeros_like(cell_means)
+        for i in range(grid_size):
+            for j in range(grid_size):
+                # Extract 3x3 region for convolution
+                region = padded_means[i : i + 3, j : j + 3]
+                # Apply Sobel filter
+                edge_response[i, j] = np.sum(region * sobel_horizontal)
+
+        # Calculate total edge response
+        total_gradient = np.sum(np.abs(edge_response))
+
+        y_central_positions.append(y)
+        gradients.append(total_gradient)
+
+    return np.array(y_central_positions), np.array(gradients)
@@ -374,7 +374,8 @@ def plot_patch_with_features(
         ax1: Matplotlib axis for the input image.
         ax2: Matplotlib axis for the patch image and features.
         ax3: Matplotlib 3D axis for observed locations.
-        input_image: The full input image
+        input_image: The full input image, None if it is not available (e.g. with
+            a feature sidecar)
         patch_image: The extracted patch
         all_column_points_tuples: List of (x,y) points for column detection
         center_edge_point: (x,y) of detected center edge
@@ -391,7 +392,17 @@ def plot_patch_with_features(
     ax3.clear()
 
     # Plot full input image on the left
-    ax1.imshow(input_image, cmap="gray")
+    if input_image is not None:
+        ax1.imshow(input_image, cmap="gray")
+    else:
+        ax1.text(
+            0.5,
+            0.5,
+            "Full image not available\n(features from feature sidecar)",
+            ha="center",
+            va="center",
+            transform=ax1.transAxes,
+        )
     ax1.set_title("Input Image")
     ax1.axis("off")
 
@@ -539,7 +550,7 @@ def plot_combined_figure(
     The second row (optional) shows hypothesis space visualizations.
 
     Args:
-        input_image: The full input image.
+        input_image: The full input image, None if it is not available.
         patch_image: The extracted patch.
         all_column_points_tuples: List of (x,y) points for column detection.
         center_edge_point: (x,y) of detected center edge.
@@ -0,0 +1,62 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Binary pose records sent by the Vive tracker server.
+
+Shared by the tracker server (scripts/htc_vive/server.py), the probe visualizer
+(scripts/visualize_probe/server.py) and the clients in custom_classes. Only
+depends on numpy, so the scripts can import it without the rest of Monty.
+"""
+
+import numpy as np
+
+# Record of one pose in the binary /poses response. Rotations are [w, x, y, z].
+POSE_RECORD_DTYPE = np.dtype(
+    [
+        ("epoch", "<f8"),
+        ("timestamp", "<f8"),
+        ("valid", "?"),
+        ("position", "<f8", (3,)),
+        ("rotation", "<f8", (4,)),
+    ]
+)
+# Record of one tracker sample pushed by /pose_stream. Rotations are [w, x, y, z].
+STREAM_RECORD_DTYPE = np.dtype(
+    [
+        ("timestamp", "<f8"),
+        ("valid", "u1"),
+        ("position", "<f8", (3,)),
+        ("rotation", "<f8", (4,)),
+    ]
+)
+assert STREAM_RECORD_DTYPE.itemsize == 65
+
+
+class StreamRecordReader:
+    """Decodes the STREAM_RECORD_DTYPE records of a /pose_stream response.
+
+    The response is read in chunks that don't have to line up with the records,
+    so the bytes of an incomplete record are kept until the rest arrives.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        """Add received bytes and decode the records they complete.
+
+        Returns:
+            np.ndarray: The completed STREAM_RECORD_DTYPE records, possibly none.
+        """
+        self._buffer += chunk
+        num_records = len(self._buffer) // STREAM_RECORD_DTYPE.itemsize
+        num_bytes = num_records * STREAM_RECORD_DTYPE.itemsize
+        records = np.frombuffer(bytes(self._buffer[:num_bytes]), STREAM_RECORD_DTYPE)
+        del self._buffer[:num_bytes]
+        return records
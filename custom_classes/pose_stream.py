@@ -0,0 +1,184 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Local mirror of the pose history of the Vive tracker server.
+
+The PoseStreamClient subscribes to /pose_stream of scripts/htc_vive/server.py on a
+background thread and keeps the pushed samples in a ring buffer, so poses can be
+looked up without a request to the tracker server for every image.
+"""
+
+import threading
+
+import numpy as np
+import quaternion as qt
+import requests
+
+from custom_classes.pose_records import STREAM_RECORD_DTYPE, StreamRecordReader
+
+
+class PoseStreamClient:
+    """Mirrors the poses pushed by the tracker server."""
+
+    def __init__(self, url, history_size=6000, reconnect_interval=1.0):
+        """Initialize the client and start receiving poses.
+
+        Args:
+            url: URL of the /pose_stream endpoint of the tracker server.
+            history_size: Number of samples kept, 60 s at 100 Hz by default.
+            reconnect_interval: Seconds to wait before reconnecting after the
+                connection to the server failed.
+        """
+        self.url = url
+        self.history_size = history_size
+        self.reconnect_interval = reconnect_interval
+        self._records = np.zeros(history_size, dtype=STREAM_RECORD_DTYPE)
+        # Index the next sample is written to, and number of stored samples
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._sample_added = threading.Condition(self._lock)
+        self._stop_event = threading.Event()
+        self._response = None
+        self._thread = threading.Thread(
+            target=self._receive, name="PoseStreamClient", daemon=True
+        )
+        self._thread.start()
+
+    def get_pose_at(self, epoch, timeout=0.05):
+        """Get the pose at a time, like the /pose?epoch= endpoint of the server.
+
+        Between two samples, the position is interpolated linearly and the
+        rotation with slerp. If epoch is after the newest received sample, this
+        waits up to timeout seconds for a newer one and otherwise uses the newest.
+
+        Args:
+            epoch: Time in seconds since the Unix epoch.
+            timeout: Maximum number of seconds to wait for a sample after epoch.
+
+        Returns:
+            The pose in the format of the "data" of the /pose response, or None if
+            epoch is before the oldest sample or a sample used for it is not
+            valid.
+        """
+        with self._sample_added:
+            self._sample_added.wait_for(
+                lambda: self._count > 0
+                and self._records["timestamp"][self._next - 1] >= epoch,
+                timeout=timeout,
+            )
+            if self._count == 0:
+                return None
+            # Buffer indices of the samples from oldest to newest
+            order = np.arange(self._next - self._count, self._next) % self.history_size
+            after_index = np.searchsorted(
+                self._records["timestamp"][order], epoch, side="right"
+            )
+            if after_index == 0:
+                return None
+            if after_index == self._count:
+                newest = self._records[order[-1]].copy()
+                if not newest["valid"]:
+                    return None
+                return self._to_pose_data(
+                    newest["timestamp"],
+                    newest["position"],
+                    qt.from_float_array(newest["rotation"]),
+                    interpolated=False,
+                )
+            before = self._records[order[after_index - 1]].copy()
+            after = self._records[order[after_index]].copy()
+
+        if not (before["valid"] and after["valid"]):
+            return None
+        fraction = (epoch - before["timestamp"]) / (
+            after["timestamp"] - before["timestamp"]
+        )
+        position = before["position"] + fraction * (
+            after["position"] - before["position"]
+        )
+        rotation_before = qt.from_float_array(before["rotation"])
+        rotation_after = qt.from_float_array(after["rotation"])
+        # Take the shorter way around
+        if np.dot(before["rotation"], after["rotation"]) < 0:
+            rotation_after = -rotation_after
+        rotation = qt.slerp_evaluate(rotation_before, rotation_after, fraction)
+        return self._to_pose_data(epoch, position, rotation, interpolated=True)
+
+    def close(self):
+        self._stop_event.set()
+        response = self._response
+        if response is not None:
+            # Interrupts the blocking read of the receiving thread
+            try:
+                response.close()
+            except (OSError, requests.RequestException) as e:
+                print(f"Error closing the pose stream from {self.url}: {e}")
+        self._thread.join(timeout=5)
+
+    def _receive(self):
+        """Receive samples until closed, reconnecting if the connection fails."""
+        while not self._stop_event.is_set():
+            reader = StreamRecordReader()
+            try:
+                with requests.get(
+                    self.url,
+                    params={"backlog": self.history_size},
+                    stream=True,
+                    timeout=(3.0, 5.0),
+                ) as response:
+                    response.raise_for_status()
+                    self._response = response
+                    print(f"Receiving poses from {self.url}")
+                    for chunk in response.iter_content(
+                        chunk_size=STREAM_RECORD_DTYPE.itemsize
+                    ):
+                        if self._stop_event.is_set():
+                            break
+                        for record in reader.feed(chunk):
+                            self._add(record)
+            except Exception as e:
+                if not self._stop_event.is_set():
+                    print(f"Pose stream from {self.url} failed: {e}")
+            finally:
+                self._response = None
+            self._stop_event.wait(self.reconnect_interval)
+
+    def _add(self, record):
+        with self._sample_added:
+            # After reconnecting, the backlog repeats samples we already have
+            if (
+                self._count > 0
+                and record["timestamp"] <= self._records["timestamp"][self._next - 1]
+            ):
+                return
+            self._records[self._next] = record
+            self._next = (self._next + 1) % self.history_size
+            self._count = min(self._count + 1, self.history_size)
+            self._sample_added.notify_all()
+
+    @staticmethod
+    def _to_pose_data(timestamp, position, rotation, interpolated):
+        return {
+            "timestamp": float(timestamp),
+            "pose": {
+                "position": {
+                    "x": float(position[0]),
+                    "y": float(position[1]),
+                    "z": float(position[2]),
+                },
+                "rotation": {
+                    "w": float(rotation.w),
+                    "x": float(rotation.x),
+                    "y": float(rotation.y),
+                    "z": float(rotation.z),
+                },
+            },
+            "interpolated": interpolated,
+        }
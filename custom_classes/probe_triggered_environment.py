@@ -1,17 +1,18 @@
 import copy
 import json
 import os
-from typing import Any, Dict
+from typing import Any, Dict, Iterable, Optional
 
 import cv2
 import numpy as np
 import quaternion as qt
-import requests
 from tbp.monty.frameworks.actions.actions import Action
 from tbp.monty.frameworks.models.buffer import BufferEncoder
 
 from custom_classes.environment import UltrasoundEnvironment
+from custom_classes.pose_stream import PoseStreamClient
 from custom_classes.server import ImageServer
+from custom_classes.tracker_client import TrackerClient
 
 
 class ProbeTriggeredUltrasoundEnvironment(UltrasoundEnvironment):
@@ -20,12 +21,42 @@ class ProbeTriggeredUltrasoundEnvironment(UltrasoundEnvironment):
         image_listen_port: int = 8000,
         vive_url: str = "http://localhost:3001/pose",
         save_path: str = None,
+        image_queue_size: int = 1,
+        image_overflow_policy: str = "drop_oldest",
+        image_grayscale: str = "luminance",
+        vive_pose_stream: bool = False,
+        vive_connect_timeout: float = 1.0,
+        vive_read_timeout: float = 0.5,
+        vive_retries: int = 2,
+        vive_pose_async: bool = False,
     ):
         super().__init__(data_path=None)
         self.image_listen_port = image_listen_port
-        self.server = ImageServer()
+        self.server = ImageServer(
+            max_queue_size=image_queue_size,
+            overflow_policy=image_overflow_policy,
+            grayscale=image_grayscale,
+        )
         self.server.start(port=image_listen_port)
         self.vive_url = vive_url
+        # Keeps the connections to the tracker server open between requests
+        self.tracker_client = TrackerClient(
+            vive_url,
+            connect_timeout=vive_connect_timeout,
+            read_timeout=vive_read_timeout,
+            retries=vive_retries,
+        )
+        # Request the pose of an image while it is being decoded
+        self.vive_pose_async = vive_pose_async
+        # Mirror of the tracker's pose history, instead of a request per image
+        self.pose_stream = None
+        if vive_pose_stream:
+            self.pose_stream = PoseStreamClient(
+                vive_url.rsplit("/", 1)[0] + "/pose_stream"
+            )
+        # Seconds the clock of the tracker server is ahead of this one, estimated
+        # on the first pose request
+        self.tracker_clock_offset = None
         self.vive_pose = None
         self.save_path = save_path
 
@@ -36,9 +67,22 @@ class ProbeTriggeredUltrasoundEnvironment(UltrasoundEnvironment):
         complete_data = False
         while not complete_data:
             self.vive_pose = None
-            current_ultrasound_image, metadata = self.server.get_next_image()
+            if self.vive_pose_async and self.pose_stream is None:
+                pose_futures = []
+                current_ultrasound_image, metadata = self.server.get_next_image(
+                    on_dequeue=lambda metadata, futures=pose_futures: futures.append(
+                        self.tracker_client.get_pose_async(
+                            self.get_tracker_time(metadata["epoch"])
+                        )
+                    )
+                )
+                self.vive_pose = pose_futures[-1].result()
+                if self.vive_pose is None:
+                    self.vive_pose = self.get_latest_vive_pose(metadata["epoch"])
+            else:
+                current_ultrasound_image, metadata = self.server.get_next_image()
+                self.vive_pose = self.get_vive_pose(metadata["epoch"])
             self.full_image = current_ultrasound_image
-            self.vive_pose = self.get_vive_pose(metadata["epoch"])
             if self.vive_pose is not None:
                 complete_data = True
             else:
@@ -103,15 +147,88 @@ class ProbeTriggeredUltrasoundEnvironment(UltrasoundEnvironment):
             json.dump(data, f, cls=BufferEncoder)
 
     def close(self):
+        if self.pose_stream is not None:
+            self.pose_stream.close()
+        print(f"Vive pose requests: {self.tracker_client.get_stats()}")
+        self.tracker_client.close()
         super().close()
 
-    def get_vive_pose(self, epoch: float) -> Dict[str, Any]:
-        try:
-            print(f"Getting vive pose for epoch: {epoch}")
-            response = requests.get(f"{self.vive_url}?epoch={epoch}")
-            print(f"Pose response: {response.json()}")
-            if not 200 <= response.status_code < 300:
-                return None
-            return response.json()["data"]
-        except Exception:
-            return None
+    def get_vive_pose(self, epoch: float) -> Optional[Dict[str, Any]]:
+        """Get the pose at a time.time() of this computer.
+
+        Falls back to the latest pose if the tracker has none at that time, e.g.
+        because it is older than the pose history of the tracker server.
+        """
+        tracker_epoch = self.get_tracker_time(epoch)
+        if self.pose_stream is not None:
+            pose = self.pose_stream.get_pose_at(tracker_epoch)
+        else:
+            pose = self.tracker_client.get_pose(tracker_epoch)
+        if pose is None:
+            pose = self.get_latest_vive_pose(epoch)
+        return pose
+
+    def get_latest_vive_pose(self, epoch: float) -> Optional[Dict[str, Any]]:
+        """Get the latest pose, for an image whose pose at epoch isn't available."""
+        print(f"WARNING: No tracker pose at {epoch}, using the latest pose instead")
+        return self.tracker_client.get_pose()
+
+    def get_tracker_time(self, epoch: float) -> float:
+        """Convert a time.time() of this computer to the clock of the tracker.
+
+        The offset between the clocks is estimated on the first call. If that
+        fails, epoch is returned unchanged and the estimate is retried next time.
+        """
+        if self.tracker_clock_offset is None:
+            self.tracker_clock_offset = self.tracker_client.estimate_clock_offset()
+            if self.tracker_clock_offset is None:
+                print(
+                    "WARNING: Could not estimate the clock offset to the tracker "
+                    "server, assuming the clocks are synchronized"
+                )
+                return epoch
+            print(
+                "The clock of the tracker server is "
+                f"{self.tracker_clock_offset:.3f}s ahead of this one"
+            )
+        return epoch + self.tracker_clock_offset
+
+    def get_vive_poses(
+        self,
+        epochs: Optional[Iterable[float]] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        stride: Optional[float] = None,
+    ) -> Optional[np.ndarray]:
+        """Get the poses at many times with one request to the tracker server.
+
+        Pass either epochs, or start and end (exclusive) with an optional stride
+        in seconds. All times are time.time() of this computer.
+
+        Returns:
+            Record array with the requested "epoch" and the "timestamp", "valid",
+            "position" and "rotation" (w, x, y, z) of each pose, or None if the
+            request failed.
+
+        Raises:
+            ValueError: If neither epochs nor start and end are given.
+        """
+        if epochs is not None:
+            params = {
+                "epochs": [self.get_tracker_time(float(epoch)) for epoch in epochs]
+            }
+        elif start is not None and end is not None:
+            params = {
+                "start": self.get_tracker_time(start),
+                "end": self.get_tracker_time(end),
+            }
+            if stride is not None:
+                params["stride"] = stride
+        else:
+            raise ValueError("Pass epochs, or start and end")
+        poses = self.tracker_client.get_poses(params)
+        if poses is not None and self.tracker_clock_offset is not None:
+            # Back to the clock of this computer
+            poses["epoch"] -= self.tracker_clock_offset
+            poses["timestamp"][poses["valid"]] -= self.tracker_clock_offset
+        return poses
@@ -9,16 +9,87 @@
 
 """Sensor module for ultrasound data processing."""
 
+import logging
+
 import numpy as np
 import quaternion as qt
 from scipy.optimize import least_squares
 from tbp.monty.frameworks.models.monty_base import SensorModuleBase
 from tbp.monty.frameworks.models.states import State
 
+from custom_classes.feature_cache import PatchFeatureCache
+
+logger = logging.getLogger(__name__)
+
 
 class UltrasoundSM(SensorModuleBase):
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        edge_extraction="vectorized",
+        circle_fit="algebraic",
+        lazy_subset_fits=False,
+        subset_target_error=None,
+        warm_start_circle_fit=False,
+        feature_cache_dir=None,
+        **kwargs,
+    ):
+        """Initialize the sensor module.
+
+        Args:
+            edge_extraction: How to find the edge points in the patch. "vectorized"
+                thresholds the scan band once, "loop" scans pixel by pixel.
+            circle_fit: How to fit the circle to the edge points. "algebraic" solves
+                all subsets in closed form and only refines bad fits with nonlinear
+                least squares, "least_squares" runs the nonlinear fit on all
+                subsets.
+            lazy_subset_fits: Only used with circle_fit="least_squares". If True,
+                the subset fits are skipped when the fit on all points is good and
+                the subsets are stopped at the first one reaching
+                subset_target_error.
+            subset_target_error: Fit error at which the lazy subset fits stop. If
+                None, the min_fit_error of fit_circle_to_points is used.
+            warm_start_circle_fit: If True, the circle center of the previous step
+                (in normalized coordinates) is used as the initial guess of the
+                least squares fits of the next step, instead of a fresh algebraic
+                guess. With circle_fit="algebraic" this applies to the refinement
+                of bad algebraic fits. The previous center is cleared at the start
+                of each episode, and after steps whose features come from the
+                feature cache (which doesn't store the circle).
+            feature_cache_dir: If set, the normal, curvature and pixel depth of
+                every patch that comes with a data_key (dataset path and step) are
+                cached in this directory and reused in later runs, skipping the
+                image processing. Plots of cached steps don't show edge points.
+            *args: passed on to SensorModuleBase.
+            **kwargs: passed on to SensorModuleBase.
+
+        Raises:
+            ValueError: If edge_extraction or circle_fit is not a known method.
+        """
         super().__init__(*args, **kwargs)
+        if edge_extraction not in ("vectorized", "loop"):
+            raise ValueError(f"Unknown edge_extraction method: {edge_extraction}")
+        if circle_fit not in ("algebraic", "least_squares"):
+            raise ValueError(f"Unknown circle_fit method: {circle_fit}")
+        self.edge_extraction = edge_extraction
+        self.circle_fit = circle_fit
+        self.lazy_subset_fits = lazy_subset_fits
+        self.subset_target_error = subset_target_error
+        self.warm_start_circle_fit = warm_start_circle_fit
+        self._previous_center_norm = None
+        self._warm_start_center = None
+        # Number of fitted steps, and of nonlinear least squares fits and their
+        # function evaluations summed over these steps
+        self.circle_fit_totals = {
+            "steps": 0,
+            "fits": 0,
+            "function_evaluations": 0,
+        }
+        self._step_function_evaluations = 0
+        # The feature cache is created on the first patch, as the features also
+        # depend on the patch size.
+        self.feature_cache_dir = feature_cache_dir
+        self.feature_cache = None
         self.plotting_data = {
             "column_points": [],
             "center_edge": None,
@@ -40,8 +111,8 @@ class UltrasoundSM(SensorModuleBase):
 
         # normal_rel_patch will point up (in y direction). In the world frame it should
         # point towards the agent.
-        normal_rel_patch, curvature, pixel_depth_in_patch = (
-            self.extract_patch_pose_feat(data["img"])
+        normal_rel_patch, curvature, pixel_depth_in_patch = self.get_patch_pose_feat(
+            data
         )
 
         # Derive depth from pixel location in image
@@ -222,6 +293,13 @@ class UltrasoundSM(SensorModuleBase):
             )
         return tracker_position, probe_position, tracker_orientation, probe_orientation
 
+    def pre_episode(self):
+        """Clear the warm start of the circle fit for the new episode."""
+        super().pre_episode()
+        self._previous_center_norm = None
+        if self.feature_cache is not None:
+            self.feature_cache.flush()
+
     def update_state(self, state):
         """Currently pass state info to step function.
 
@@ -229,6 +307,142 @@ class UltrasoundSM(SensorModuleBase):
         """
         pass
 
+    def get_feature_settings_key(self, patch_shape):
+        """Get a string describing the settings the patch features depend on.
+
+        Features extracted with the same key are interchangeable, so the key is
+        used to check cached and precomputed features.
+        """
+        return repr(
+            (
+                tuple(patch_shape),
+                self.edge_extraction,
+                self.circle_fit,
+                self.lazy_subset_fits,
+                self.subset_target_error,
+                self.warm_start_circle_fit,
+            )
+        )
+
+    def get_patch_pose_feat(self, data):
+        """Get the patch pose features from precomputed features, the feature cache
+        or the patch image.
+
+        Args:
+            data (dict): Patch observation. If it contains features precomputed
+                with the same settings (from a feature sidecar), these are used.
+                Otherwise, if it contains a data_key (dataset path, step) and a
+                feature cache is used, the features are looked up in and added to
+                the cache.
+
+        Returns:
+            tuple: (normal_3d, curvature, y_depth_in_image), see
+                extract_patch_pose_feat.
+        """
+        settings_key = self.get_feature_settings_key(data["img"].shape)
+        features = data.get("features")
+        if features is not None and features["settings_key"] == settings_key:
+            self.plotting_data["column_points"] = features["column_points"]
+            self.plotting_data["center_edge"] = features["center_edge"]
+            self.plotting_data["fitted_circle"] = features["fitted_circle"]
+            self._set_previous_center(
+                features["fitted_circle"],
+                features["center_edge"],
+                np.asarray(features["column_points"], dtype=float).reshape(-1, 2),
+            )
+            return features["normal"], features["curvature"], features["pixel_depth"]
+
+        data_key = data.get("data_key")
+        if self.feature_cache_dir is None or data_key is None:
+            return self.extract_patch_pose_feat(data["img"])
+
+        if self.feature_cache is None or (
+            self.feature_cache.settings_key != settings_key
+        ):
+            if self.feature_cache is not None:
+                self.feature_cache.flush()
+            self.feature_cache = PatchFeatureCache(self.feature_cache_dir, settings_key)
+
+        dataset_path, step = data_key
+        cached_features = self.feature_cache.get(dataset_path, step)
+        if cached_features is not None:
+            normal_3d, curvature, y_depth_in_image = cached_features
+            self.plotting_data["column_points"] = []
+            self.plotting_data["center_edge"] = (
+                data["img"].shape[1] // 2,
+                y_depth_in_image,
+            )
+            self.plotting_data["fitted_circle"] = None
+            self._previous_center_norm = None
+            return normal_3d, curvature, y_depth_in_image
+
+        normal_3d, curvature, y_depth_in_image = self.extract_patch_pose_feat(
+            data["img"]
+        )
+        self.feature_cache.put(
+            dataset_path, step, normal_3d, curvature, y_depth_in_image
+        )
+        return normal_3d, curvature, y_depth_in_image
+
+    def extract_patch_pose_feat_batch(self, patches, return_fit_details=False):
+        """Extract the patch pose features of a stack of patches.
+
+        The edge points of all patches are extracted in one vectorized pass, the
+        circles are then fitted patch by patch in order. The plotting data is not
+        updated.
+
+        Args:
+            patches (np.ndarray): Stack of grayscale patches of shape (N, H, W).
+            return_fit_details (bool): If True, also return the edge points and
+                fitted circles.
+
+        Returns:
+            tuple: (normals, curvatures, y_depths_in_image) of shapes (N, 3), (N,)
+                and (N,), see extract_patch_pose_feat. With return_fit_details, a
+                dict is appended with the edge_rows, has_edge and
+                center_edge_points of extract_edge_points_batch and the
+                fitted_circles as an (N, 3) array of (x, y, radius), NaN where the
+                edge points were fitted with a line.
+        """
+        patches = np.asarray(patches)
+        num_patches = len(patches)
+        edge_rows, has_edge, center_edge_points = self.extract_edge_points_batch(
+            patches
+        )
+
+        normals = np.zeros((num_patches, 3))
+        curvatures = np.zeros(num_patches)
+        y_depths_in_image = np.zeros(num_patches)
+        fitted_circles = np.full((num_patches, 3), np.nan)
+        for i in range(num_patches):
+            edge_columns = np.flatnonzero(has_edge[i])
+            all_column_points_np = np.stack(
+                [edge_columns, edge_rows[i, edge_columns]], axis=1
+            ).astype(float)
+            center_edge_point = tuple(center_edge_points[i])
+
+            fit_params, curvatures[i] = self.fit_circle_to_points(
+                patches[i], all_column_points_np, center_edge_point
+            )
+            normals[i] = self.calculate_normal_from_fit(fit_params, center_edge_point)
+            y_depths_in_image[i] = center_edge_point[1]
+            if fit_params is not None and not fit_params.get("is_line", True):
+                fitted_circles[i] = (
+                    fit_params["center"][0],
+                    fit_params["center"][1],
+                    fit_params["radius"],
+                )
+
+        if return_fit_details:
+            fit_details = {
+                "edge_rows": edge_rows,
+                "has_edge": has_edge,
+                "center_edge_points": center_edge_points,
+                "fitted_circles": fitted_circles,
+            }
+            return normals, curvatures, y_depths_in_image, fit_details
+        return normals, curvatures, y_depths_in_image
+
     def extract_patch_pose_feat(self, patch):
         """Extract patch pose features including curvature and surface normal from a 256x256 grayscale image.
 
@@ -244,7 +458,14 @@ class UltrasoundSM(SensorModuleBase):
                   and curvature is a float representing the local curvature.
         """
         # Get points on the first edge (from top) in the image
-        all_column_points_tuples, center_edge_point = self.extract_edge_points(patch)
+        if self.edge_extraction == "vectorized":
+            all_column_points_tuples, center_edge_point = self.extract_edge_points(
+                patch
+            )
+        else:
+            all_column_points_tuples, center_edge_point = self.extract_edge_points_loop(
+                patch
+            )
         all_column_points_np = np.array(all_column_points_tuples)
 
         # Store data for plotting
@@ -274,6 +495,100 @@ class UltrasoundSM(SensorModuleBase):
         return normal_3d, curvature, y_depth_in_image
 
     def extract_edge_points(self, image):
+        """Extract edge points from the image by finding the first pixel in each column
+        with an intensity above a threshold.
+
+        Vectorized version of extract_edge_points_loop. The scan band is thresholded
+        once and the first crossing in every column is found with argmax (see
+        extract_edge_points_batch).
+
+        Args:
+            image (np.ndarray): Grayscale image (e.g., 256x256).
+
+        Returns:
+            tuple: (all_column_points_tuples, center_edge_point) where:
+                - all_column_points_tuples is a list of (x,y) tuples representing edge points
+                - center_edge_point is the (x,y) coordinates at the center column
+        """
+        edge_rows, has_edge, center_edge_points = self.extract_edge_points_batch(
+            image[np.newaxis]
+        )
+        edge_rows, has_edge = edge_rows[0], has_edge[0]
+
+        edge_columns = np.flatnonzero(has_edge)
+        all_column_points_tuples = list(
+            zip(
+                edge_columns.astype(float).tolist(),
+                edge_rows[edge_columns].astype(float).tolist(),
+            )
+        )
+        center_edge_point = tuple(center_edge_points[0].tolist())
+
+        return all_column_points_tuples, center_edge_point
+
+    def extract_edge_points_batch(self, images):
+        """Extract the edge points of a stack of images at once.
+
+        Same as extract_edge_points, with the threshold and scan band determined per
+        image.
+
+        Args:
+            images (np.ndarray): Stack of grayscale images of shape (N, H, W).
+
+        Returns:
+            tuple: (edge_rows, has_edge, center_edge_points) where:
+                - edge_rows is an (N, W) array with the row of the first pixel above
+                  the threshold in the scan band of each column
+                - has_edge is an (N, W) boolean array, False for columns without
+                  an edge point (their edge_rows entry is meaningless)
+                - center_edge_points is an (N, 2) float array with the (x,y)
+                  coordinates of the center edge point of each image
+        """
+        num_images, image_height, image_width = images.shape[:3]
+
+        # Calculate adaptive white threshold based on image max intensity
+        max_intensity = np.max(images, axis=(1, 2))
+        WHITE_THRESHOLD = np.maximum(50, 0.3 * max_intensity)
+
+        # range around center y to scan for edge points
+        Y_SCAN_RANGE = 50
+        center_x = image_width // 2
+
+        # Find approximate center y by looking at center column. Default to the
+        # center of the image if no edge is found.
+        center_column_white = images[:, :, center_x] > WHITE_THRESHOLD[:, None]
+        y_center = np.where(
+            center_column_white.any(axis=1),
+            np.argmax(center_column_white, axis=1),
+            image_height // 2,
+        )
+
+        # Gather the scan band of every image. Bands cut off at the bottom of the
+        # image are masked out.
+        y_min_scan = np.maximum(0, y_center - Y_SCAN_RANGE)
+        y_max_scan = np.minimum(image_height, y_center + Y_SCAN_RANGE + 1)
+        band_rows = y_min_scan[:, None] + np.arange(2 * Y_SCAN_RANGE + 1)
+        in_band = band_rows < y_max_scan[:, None]
+        band = images[
+            np.arange(num_images)[:, None], np.minimum(band_rows, image_height - 1)
+        ]
+        band_white = (band > WHITE_THRESHOLD[:, None, None]) & in_band[:, :, None]
+
+        # argmax returns the first True row of each column, the mask tells us which
+        # columns have an edge at all.
+        has_edge = band_white.any(axis=1)
+        edge_rows = np.argmax(band_white, axis=1) + y_min_scan[:, None]
+
+        # If no center point was found, use the middle of the image
+        center_edge_points = np.empty((num_images, 2))
+        center_edge_points[:, 0] = center_x
+        center_edge_points[:, 1] = np.where(
+            has_edge[:, center_x], edge_rows[:, center_x], y_center
+        )
+
+        return edge_rows, has_edge, center_edge_points
+
+    def extract_edge_points_loop(self, image):
         """Extract edge points from the image by scanning each column for intensity values
         above a threshold.
 
@@ -325,15 +640,28 @@ class UltrasoundSM(SensorModuleBase):
 
         return all_column_points_tuples, center_edge_point
 
-    def fit_circle_to_points(self, image, all_column_points_np, edge_point):
+    def fit_circle_to_points(
+        self,
+        image,
+        all_column_points_np,
+        edge_point,
+        subset_percentages=(0.9, 0.8, 0.7, 0.6, 0.5, 0.4),
+        min_fit_error=0.05,
+    ):
         """Fits a circle to the detected edge points to get curvature.
 
         Also makes sure the circle passes through the edge point at the center column.
+        If the fit on all points has a high error, fits on subsets with fewer points
+        towards the left and right side of the image are tried as well.
 
         Args:
             image (np.ndarray): The input image for visualization.
             all_column_points_np (np.ndarray): Array of (x,y) points representing the edge.
             edge_point (tuple): (x,y) coordinates of the center edge point.
+            subset_percentages (tuple): Fractions of the points to keep for the subset
+                fits, removing points equally from both ends.
+            min_fit_error (float): MSE (in normalized coordinates) above which a
+                fit is considered bad.
 
         Returns:
             tuple: (fit_params, curvature) where:
@@ -351,233 +679,466 @@ class UltrasoundSM(SensorModuleBase):
                 "is_line": True,
                 "points_used": [edge_point],
                 "retry_count": 0,
+                "num_fits": 0,
             }
             final_curvature = 0.0
+            self.circle_fit_totals["steps"] += 1
+            self._previous_center_norm = None
             return fit_params, final_curvature
 
-        # Define function to fit a circle through P0 and minimize geometric error
-        def fit_circle_through_point(points, P0, calc_error=False):
-            """
-            Fit a circle (a,b,r) to `points` minimising geometric
-            error, while forcing the circle to pass exactly through P0.
-
-            Parameters
-            ----------
-            points : (N,2) array-like
-                Points to fit circle to
-            P0 : length-2 iterable
-                The fixed point (x0,y0) the circle must pass through
-            calc_error : bool, optional
-                If True, return the mean squared residual as a measure of fit quality
-
-            Returns
-            -------
-            tuple
-                ((a,b), r, error) if calc_error=True, else ((a,b), r)
-                where (a,b) is the center, r is the radius, and error is the MSE
-            """
-            pts = np.asarray(points, dtype=float)
-            x0, y0 = P0
-
-            # Helper: residuals for LSQ over (a,b) only
-            def residuals(ab):
-                a, b = ab
-                r = np.hypot(x0 - a, y0 - b)  # constraint - circle passes through P0
-                return np.hypot(pts[:, 0] - a, pts[:, 1] - b) - r
+        self._step_function_evaluations = 0
+        self._warm_start_center = None
+        if self.warm_start_circle_fit and self._previous_center_norm is not None:
+            scale = self._get_normalization(all_column_points_np)[2]
+            self._warm_start_center = (
+                edge_point[0] + self._previous_center_norm[0] * scale,
+                edge_point[1] + self._previous_center_norm[1] * scale,
+            )
+        if self.circle_fit == "algebraic":
+            fit_function = self.fit_circle_algebraic
+        else:
+            fit_function = self.fit_circle_least_squares
+        (
+            (center_norm, radius_norm, fit_error, mean_x, mean_y, std_xy),
+            points_to_use,
+            use_subset,
+            final_displayed_retry_count,
+            num_fits,
+        ) = fit_function(
+            all_column_points_np, edge_point, subset_percentages, min_fit_error
+        )
+        self.circle_fit_totals["steps"] += 1
+        self.circle_fit_totals["fits"] += num_fits
+        self.circle_fit_totals["function_evaluations"] += (
+            self._step_function_evaluations
+        )
 
-            # Initial guess using crude algebraic fit
-            x, y = pts[:, 0], pts[:, 1]
-            A = np.c_[2 * x, 2 * y, np.ones_like(x)]
-            try:
-                c, _, _, _ = np.linalg.lstsq(A, x**2 + y**2, rcond=None)
-                a0, b0 = c[0], c[1]
-            except np.linalg.LinAlgError:
-                # Fallback if algebraic fit fails
-                a0, b0 = np.mean(pts[:, 0]), np.mean(pts[:, 1])
+        # Check if the fit is valid
+        if center_norm is None or radius_norm > 1e6 or radius_norm < 1e-6:
+            # The points are nearly collinear or the fit is unstable
+            fit_params = {
+                "is_line": True,
+                "points_used": [edge_point],
+                "retry_count": final_displayed_retry_count,
+                "num_fits": num_fits,
+            }
+            final_curvature = 0.0
+            self._previous_center_norm = None
+        else:
+            # Denormalize the results
+            center_x = center_norm[0] * std_xy + mean_x
+            center_y = center_norm[1] * std_xy + mean_y
+            radius = radius_norm * std_xy
 
-            try:
-                res = least_squares(residuals, x0=[a0, b0], method="trf")
-                a, b = res.x
-                r = np.hypot(x0 - a, y0 - b)  # exact by construction
-
-                if calc_error:
-                    # Calculate mean squared error
-                    final_residuals = residuals([a, b])
-                    mse = np.mean(np.square(final_residuals))
-                    return (a, b), r, mse
-                else:
-                    return (a, b), r
-            except Exception:
-                # In case optimization fails
-                if calc_error:
-                    return None, float("inf"), float("inf")
-                else:
-                    return None, float("inf")
-
-        # Function to normalize points for numerical stability
-        def normalize_and_fit(points, P0):
-            # Normalize data for numerical stability
-            mean_x = np.mean(points[:, 0])
-            mean_y = np.mean(points[:, 1])
-            std_xy = np.std(points, axis=0).mean()
-
-            # Guard against zero standard deviation
-            if std_xy < 1e-8:
-                std_xy = 1.0
-
-            # Normalize points and the fixed point P0
-            norm_points = (points - [mean_x, mean_y]) / std_xy
-            norm_P0 = ((P0[0] - mean_x) / std_xy, (P0[1] - mean_y) / std_xy)
-
-            # Fit circle to normalized points (with error calculation)
-            center_norm, radius_norm, fit_error = fit_circle_through_point(
-                norm_points, norm_P0, calc_error=True
+            self._set_previous_center(
+                (center_x, center_y), edge_point, all_column_points_np
             )
 
-            return center_norm, radius_norm, fit_error, mean_x, mean_y, std_xy
+            # Calculate curvature (1/radius)
+            final_curvature = 1.0 / radius if radius > 1e-6 else 0.0
 
-        # First attempt with all points
-        center_norm, radius_norm, fit_error, mean_x, mean_y, std_xy = normalize_and_fit(
-            all_column_points_np, edge_point
-        )
+            # Convert points to tuples for visualization
+            points_tuples = [tuple(pt) for pt in points_to_use]
 
-        # Decide whether to use all points or a subset
-        use_subset = False
-        best_subset_error = float("inf")
-        best_subset_params = None
-        best_subset_points = None
-        attempt_num_for_best_subset = 0
-        retry_count = 0
+            # Store the fit parameters for visualization
+            fit_params = {
+                "is_line": False,
+                "center": (center_x, center_y),
+                "radius": radius,
+                "points_used": [edge_point]
+                + points_tuples,  # Include P0 and used points
+                "inliers_percent": len(points_to_use) / len(all_column_points_np)
+                if len(all_column_points_np) > 0
+                else 0.0,
+                "retry_count": final_displayed_retry_count,
+                "fit_error": fit_error,
+                "used_subset": use_subset,
+                "num_fits": num_fits,
+            }
 
-        # TODO: make these function parameters
-        subset_percentages = [0.9, 0.8, 0.7, 0.6, 0.5, 0.4]
-        min_fit_error = 0.05
+        return fit_params, final_curvature
 
-        for percentage in subset_percentages:
-            retry_count += 1
+    def fit_circle_least_squares(
+        self, all_column_points_np, edge_point, subset_percentages, min_fit_error
+    ):
+        """Fits the circle with a nonlinear least squares solve for every subset.
 
-            # Calculate how many points to keep from each end
-            total_points = len(all_column_points_np)
-            points_to_keep = int(total_points * percentage)
+        With lazy_subset_fits, the subsets are only fitted if the fit on all points
+        is bad, and stop at the first subset with an error of at most
+        subset_target_error.
 
-            # Ensure we keep a minimum number of points
-            if points_to_keep < 10:
-                points_to_keep = min(10, total_points)
+        Args:
+            all_column_points_np (np.ndarray): Array of (x,y) points representing the edge.
+            edge_point (tuple): (x,y) coordinates of the center edge point.
+            subset_percentages (tuple): Fractions of the points to keep for the subset
+                fits.
+            min_fit_error (float): MSE above which the fit on all points is replaced
+                by the best subset fit.
 
-            # Determine start/end indices for subsetting
-            points_to_remove = (total_points - points_to_keep) // 2
-            if 2 * points_to_remove + points_to_keep > total_points:
-                points_to_remove = (total_points - points_to_keep) // 2
+        Returns:
+            tuple: (fit, points_to_use, use_subset, retry_count, num_fits) where fit
+                is the (center_norm, radius_norm, fit_error, mean_x, mean_y, std_xy)
+                tuple of the selected fit, points_to_use the points it was fitted to,
+                use_subset whether these are a subset, retry_count the attempt
+                number of that subset and num_fits the number of least squares fits
+                that were run.
+        """
+        # First attempt with all points
+        full_fit = self._normalize_and_fit(all_column_points_np, edge_point)
+        fit_error, radius_norm = full_fit[2], full_fit[1]
+        num_fits = 1
+        full_fit_is_good = fit_error <= min_fit_error and 0 < radius_norm <= 1e6
+        if self.lazy_subset_fits and full_fit_is_good:
+            return full_fit, all_column_points_np, False, 0, num_fits
 
-            start_idx = points_to_remove
-            end_idx = total_points - points_to_remove
+        target_error = self.subset_target_error
+        if target_error is None:
+            target_error = min_fit_error
 
-            # Safety check
-            if start_idx < 0:
-                start_idx = 0
-            if end_idx > total_points:
-                end_idx = total_points
-            if end_idx - start_idx < 3:
-                print(
-                    f"  Retry {retry_count}: Not enough points to subset ({end_idx - start_idx})"
-                )
-                continue
+        # Decide whether to use all points or a subset
+        use_subset = False
+        best_subset_error = float("inf")
+        best_subset_params = None
+        best_subset_points = None
+        attempt_num_for_best_subset = 0
 
+        for retry_count, start_idx, end_idx in self._get_subset_ranges(
+            len(all_column_points_np), subset_percentages
+        ):
             # Create subset by removing points from start and end
             subset_points = all_column_points_np[start_idx:end_idx]
 
             # Try fit with subset
             try:
-                (
-                    center_norm_subset,
-                    radius_norm_subset,
-                    fit_error_subset,
-                    mean_x_subset,
-                    mean_y_subset,
-                    std_xy_subset,
-                ) = normalize_and_fit(subset_points, edge_point)
+                num_fits += 1
+                subset_params = self._normalize_and_fit(subset_points, edge_point)
+                radius_norm_subset, fit_error_subset = subset_params[1:3]
 
                 # Sanity check on the radius
                 if radius_norm_subset <= 0 or radius_norm_subset > 1e6:
-                    print(f"    Skipping: Invalid radius {radius_norm_subset}")
+                    logger.debug(
+                        f"Retry {retry_count}: Invalid radius {radius_norm_subset}"
+                    )
                     continue
 
                 # Update best subset if this is better
                 if fit_error_subset < best_subset_error:
                     best_subset_error = fit_error_subset
-                    best_subset_params = (
-                        center_norm_subset,
-                        radius_norm_subset,
-                        fit_error_subset,
-                        mean_x_subset,
-                        mean_y_subset,
-                        std_xy_subset,
-                    )
+                    best_subset_params = subset_params
                     best_subset_points = subset_points
                     attempt_num_for_best_subset = retry_count
 
             except Exception as e:
-                print(f"  Error in retry {retry_count}: {str(e)}")
+                logger.debug(f"Error in retry {retry_count}: {str(e)}")
+
+            if self.lazy_subset_fits and best_subset_error <= target_error:
+                break
 
         # Decide whether to use the subset
-        if best_subset_params is not None:
-            # Always use subset if original has high error or bad radius
-            if fit_error > min_fit_error or radius_norm <= 0 or radius_norm > 1e6:
-                use_subset = True
-
-            # If using subset, update parameters
-            if use_subset:
-                center_norm, radius_norm, fit_error, mean_x, mean_y, std_xy = (
-                    best_subset_params
+        # Always use subset if original has high error or bad radius
+        if best_subset_params is not None and not full_fit_is_good:
+            return (
+                best_subset_params,
+                best_subset_points,
+                True,
+                attempt_num_for_best_subset,
+                num_fits,
+            )
+        # No valid subset found or fit on all points is good, use original
+        return full_fit, all_column_points_np, use_subset, 0, num_fits
+
+    def fit_circle_algebraic(
+        self, all_column_points_np, edge_point, subset_percentages, min_fit_error
+    ):
+        """Fits the circle to all subsets at once with a closed form solution.
+
+        Forcing the circle through P0 = edge_point, (x-a)^2 + (y-b)^2 = r^2 with
+        r^2 = (x0-a)^2 + (y0-b)^2 becomes linear in the center. With coordinates
+        relative to P0 each point gives 2*a*u + 2*b*v = u^2 + v^2, so every subset
+        is a 2x2 least squares problem. Since the subsets are contiguous ranges of
+        the points, their normal equations are differences of cumulative sums and
+        all of them are solved together. The subset is then selected with the same
+        rules as fit_circle_least_squares, using the geometric MSE of the algebraic
+        fits. Only fits with an error above min_fit_error are refined with the
+        nonlinear least squares fit, i.e. at most the fit on all points and the
+        selected subset.
+
+        Args:
+            all_column_points_np (np.ndarray): Array of (x,y) points representing the edge.
+            edge_point (tuple): (x,y) coordinates of the center edge point.
+            subset_percentages (tuple): Fractions of the points to keep for the subset
+                fits.
+            min_fit_error (float): MSE above which the fit on all points is replaced
+                by the best subset fit and the selected fit is refined.
+
+        Returns:
+            tuple: (fit, points_to_use, use_subset, retry_count, num_fits), see
+                fit_circle_least_squares.
+        """
+        points = np.asarray(all_column_points_np, dtype=float)
+        total_points = len(points)
+        ranges = [(0, 0, total_points)] + self._get_subset_ranges(
+            total_points, subset_percentages
+        )
+        retry_counts = np.array([r[0] for r in ranges])
+        starts = np.array([r[1] for r in ranges])
+        ends = np.array([r[2] for r in ranges])
+
+        # Points relative to P0, scaled for numerical stability
+        scale = self._get_normalization(points)[2]
+        u = (points[:, 0] - edge_point[0]) / scale
+        v = (points[:, 1] - edge_point[1]) / scale
+        w = u**2 + v**2
+
+        # Normal equations of every range from cumulative sums
+        terms = np.stack([u * u, u * v, v * v, u * w, v * w])
+        cumulative = np.concatenate((np.zeros((5, 1)), np.cumsum(terms, axis=1)), 1)
+        s_uu, s_uv, s_vv, s_uw, s_vw = cumulative[:, ends] - cumulative[:, starts]
+
+        # Cramer's rule for [[s_uu, s_uv], [s_uv, s_vv]] @ (2a, 2b) = (s_uw, s_vw)
+        det = s_uu * s_vv - s_uv**2
+        solvable = det > 1e-12 * s_uu * s_vv
+        safe_det = np.where(solvable, det, 1.0)
+        a = (s_vv * s_uw - s_uv * s_vw) / (2 * safe_det)
+        b = (s_uu * s_vw - s_uv * s_uw) / (2 * safe_det)
+
+        # Back to pixel coordinates
+        centers = np.stack([a, b], axis=1) * scale + np.asarray(edge_point)
+        radii = np.hypot(a, b) * scale
+
+        # Geometric MSE of each fit, in the normalized coordinates of its range as
+        # used by the least squares fit.
+        in_range = (np.arange(total_points) >= starts[:, None]) & (
+            np.arange(total_points) < ends[:, None]
+        )
+        distances = np.hypot(
+            points[None, :, 0] - centers[:, None, 0],
+            points[None, :, 1] - centers[:, None, 1],
+        )
+        squared_residuals = np.where(in_range, (distances - radii[:, None]) ** 2, 0.0)
+        range_fits = []
+        for k in range(len(ranges)):
+            mean_x, mean_y, std_xy = self._get_normalization(
+                points[starts[k] : ends[k]]
+            )
+            if solvable[k]:
+                center_norm = (
+                    (centers[k, 0] - mean_x) / std_xy,
+                    (centers[k, 1] - mean_y) / std_xy,
+                )
+                radius_norm = radii[k] / std_xy
+                fit_error = np.sum(squared_residuals[k]) / (
+                    (ends[k] - starts[k]) * std_xy**2
                 )
-                points_to_use = best_subset_points
             else:
-                points_to_use = all_column_points_np
-        else:
+                center_norm, radius_norm, fit_error = None, float("inf"), float("inf")
+            range_fits.append(
+                (center_norm, radius_norm, fit_error, mean_x, mean_y, std_xy)
+            )
+
+        # Same selection as with the least squares fits. A bad algebraic fit on all
+        # points is refined first, since the geometric optimum may still be good.
+        full_fit = range_fits[0]
+        num_fits = 0
+        if full_fit[2] > min_fit_error:
+            num_fits += 1
+            full_fit = self._refine_algebraic_fit(
+                full_fit, points, edge_point, centers[0] if solvable[0] else None
+            )
+        if full_fit[2] <= min_fit_error and 0 < full_fit[1] <= 1e6:
+            return full_fit, all_column_points_np, False, 0, num_fits
+
+        subset_errors = [
+            fit[2] if 0 < fit[1] <= 1e6 else float("inf") for fit in range_fits[1:]
+        ]
+        if not subset_errors or np.min(subset_errors) == float("inf"):
             # No valid subset found, use original
-            points_to_use = all_column_points_np
+            return full_fit, all_column_points_np, False, 0, num_fits
+
+        selected = 1 + int(np.argmin(subset_errors))
+        points_to_use = all_column_points_np[starts[selected] : ends[selected]]
+        fit = range_fits[selected]
+        if fit[2] > min_fit_error:
+            num_fits += 1
+            fit = self._refine_algebraic_fit(
+                fit, points_to_use, edge_point, centers[selected]
+            )
 
-        final_displayed_retry_count = 0
-        if use_subset:
-            final_displayed_retry_count = attempt_num_for_best_subset
+        return fit, points_to_use, True, int(retry_counts[selected]), num_fits
 
-        # Check if the fit is valid
-        if center_norm is None or radius_norm > 1e6 or radius_norm < 1e-6:
-            # The points are nearly collinear or the fit is unstable
-            fit_params = {
-                "is_line": True,
-                "points_used": [edge_point],
-                "retry_count": final_displayed_retry_count,
-            }
-            final_curvature = 0.0
-        else:
-            # Denormalize the results
-            center_x = center_norm[0] * std_xy + mean_x
-            center_y = center_norm[1] * std_xy + mean_y
-            radius = radius_norm * std_xy
+    def _refine_algebraic_fit(self, fit, points, edge_point, center_guess):
+        """Refines an algebraic fit with nonlinear least squares if this succeeds.
 
-            # Calculate curvature (1/radius)
-            final_curvature = 1.0 / radius if radius > 1e-6 else 0.0
+        Starts from the center of the previous step with warm_start_circle_fit if
+        there is one, and from center_guess otherwise.
+        """
+        if self._warm_start_center is not None:
+            center_guess = self._warm_start_center
+        refined_fit = self._normalize_and_fit(
+            points, edge_point, initial_center=center_guess
+        )
+        if refined_fit[0] is None:
+            return fit
+        return refined_fit
 
-            # Convert points to tuples for visualization
-            points_tuples = [tuple(pt) for pt in points_to_use]
+    def _set_previous_center(self, center, edge_point, all_column_points_np):
+        """Keep a circle center for the warm start of the next step.
 
-            # Store the fit parameters for visualization
-            fit_params = {
-                "is_line": False,
-                "center": (center_x, center_y),
-                "radius": radius,
-                "points_used": [edge_point]
-                + points_tuples,  # Include P0 and used points
-                "inliers_percent": len(points_to_use) / len(all_column_points_np)
-                if len(all_column_points_np) > 0
-                else 0.0,
-                "retry_count": final_displayed_retry_count,
-                "fit_error": fit_error,
-                "used_subset": use_subset,
-            }
+        The center is kept relative to P0, normalized by the spread of all edge
+        points, so it can be mapped onto the points of the next step.
 
-        return fit_params, final_curvature
+        Args:
+            center (tuple): (x, y) center of the fitted circle in pixels, None if
+                the points were fitted with a line.
+            edge_point (tuple): (x, y) coordinates of the center edge point.
+            all_column_points_np (np.ndarray): (N, 2) edge points of the step.
+        """
+        if center is None or len(all_column_points_np) < 3:
+            self._previous_center_norm = None
+            return
+        scale = self._get_normalization(all_column_points_np)[2]
+        self._previous_center_norm = (
+            (center[0] - edge_point[0]) / scale,
+            (center[1] - edge_point[1]) / scale,
+        )
+
+    def _get_subset_ranges(self, total_points, subset_percentages):
+        """Returns (retry_count, start_idx, end_idx) of the subsets to try."""
+        subset_ranges = []
+        for retry_count, percentage in enumerate(subset_percentages, start=1):
+            # Calculate how many points to keep from each end
+            points_to_keep = int(total_points * percentage)
+
+            # Ensure we keep a minimum number of points
+            if points_to_keep < 10:
+                points_to_keep = min(10, total_points)
+
+            # Determine start/end indices for subsetting
+            points_to_remove = (total_points - points_to_keep) // 2
+            start_idx = max(points_to_remove, 0)
+            end_idx = min(total_points - points_to_remove, total_points)
+
+            if end_idx - start_idx < 3:
+                logger.debug(
+                    f"Retry {retry_count}: Not enough points to subset "
+                    f"({end_idx - start_idx})"
+                )
+                continue
+            subset_ranges.append((retry_count, start_idx, end_idx))
+        return subset_ranges
+
+    def _get_normalization(self, points):
+        """Returns the mean x, mean y and scale used to normalize the points."""
+        mean_x = np.mean(points[:, 0])
+        mean_y = np.mean(points[:, 1])
+        std_xy = np.std(points, axis=0).mean()
+
+        # Guard against zero standard deviation
+        if std_xy < 1e-8:
+            std_xy = 1.0
+        return mean_x, mean_y, std_xy
+
+    def _normalize_and_fit(self, points, P0, initial_center=None):
+        """Fits a circle through P0 to normalized points.
+
+        Args:
+            points (np.ndarray): (N,2) points to fit the circle to.
+            P0 (tuple): The fixed point (x0,y0) the circle must pass through.
+            initial_center (tuple, optional): Initial guess of the center in pixel
+                coordinates. If None, the center of the previous step is used with
+                warm_start_circle_fit and a crude algebraic fit otherwise.
+
+        Returns:
+            tuple: (center_norm, radius_norm, fit_error, mean_x, mean_y, std_xy)
+        """
+        # Normalize data for numerical stability
+        mean_x, mean_y, std_xy = self._get_normalization(points)
+
+        # Normalize points and the fixed point P0
+        norm_points = (points - [mean_x, mean_y]) / std_xy
+        norm_P0 = ((P0[0] - mean_x) / std_xy, (P0[1] - mean_y) / std_xy)
+        if initial_center is None and self.warm_start_circle_fit:
+            initial_center = self._warm_start_center
+        norm_initial_center = None
+        if initial_center is not None:
+            norm_initial_center = (
+                (initial_center[0] - mean_x) / std_xy,
+                (initial_center[1] - mean_y) / std_xy,
+            )
+
+        # Fit circle to normalized points (with error calculation)
+        center_norm, radius_norm, fit_error = self._fit_circle_through_point(
+            norm_points, norm_P0, calc_error=True, initial_center=norm_initial_center
+        )
+
+        return center_norm, radius_norm, fit_error, mean_x, mean_y, std_xy
+
+    def _fit_circle_through_point(
+        self, points, P0, calc_error=False, initial_center=None
+    ):
+        """
+        Fit a circle (a,b,r) to `points` minimising geometric
+        error, while forcing the circle to pass exactly through P0.
+
+        Parameters
+        ----------
+        points : (N,2) array-like
+            Points to fit circle to
+        P0 : length-2 iterable
+            The fixed point (x0,y0) the circle must pass through
+        calc_error : bool, optional
+            If True, return the mean squared residual as a measure of fit quality
+        initial_center : length-2 iterable, optional
+            Initial guess (a,b) of the center. If None, a crude algebraic fit is
+            used.
+
+        Returns
+        -------
+        tuple
+            ((a,b), r, error) if calc_error=True, else ((a,b), r)
+            where (a,b) is the center, r is the radius, and error is the MSE
+        """
+        pts = np.asarray(points, dtype=float)
+        x0, y0 = P0
+
+        # Helper: residuals for LSQ over (a,b) only
+        def residuals(ab):
+            a, b = ab
+            r = np.hypot(x0 - a, y0 - b)  # constraint - circle passes through P0
+            return np.hypot(pts[:, 0] - a, pts[:, 1] - b) - r
+
+        if initial_center is not None:
+            a0, b0 = initial_center
+        else:
+            # Initial guess using crude algebraic fit
+            x, y = pts[:, 0], pts[:, 1]
+            A = np.c_[2 * x, 2 * y, np.ones_like(x)]
+            try:
+                c, _, _, _ = np.linalg.lstsq(A, x**2 + y**2, rcond=None)
+                a0, b0 = c[0], c[1]
+            except np.linalg.LinAlgError:
+                # Fallback if algebraic fit fails
+                a0, b0 = np.mean(pts[:, 0]), np.mean(pts[:, 1])
+
+        try:
+            res = least_squares(residuals, x0=[a0, b0], method="trf")
+            self._step_function_evaluations += res.nfev
+            a, b = res.x
+            r = np.hypot(x0 - a, y0 - b)  # exact by construction
+
+            if calc_error:
+                # Calculate mean squared error
+                final_residuals = residuals([a, b])
+                mse = np.mean(np.square(final_residuals))
+                return (a, b), r, mse
+            else:
+                return (a, b), r
+        except Exception:
+            # In case optimization fails
+            if calc_error:
+                return None, float("inf"), float("inf")
+            else:
+                return None, float("inf")
 
     def calculate_normal_from_fit(self, fit_params, edge_point):
         """Calculate the normal vector based on the fitted circle/line.
@@ -1,23 +1,144 @@
 import atexit
+import collections
+import concurrent.futures
 import io
 import json
+import logging
+import struct
 import threading
 import time
-from typing import Any, Dict, Tuple
+from typing import Any, Callable, Dict, Optional, Tuple
 
 import numpy as np
 import uvicorn
-from fastapi import FastAPI, Request, UploadFile
+from fastapi import FastAPI, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from PIL import Image
 
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+GRAYSCALE_MODES = ("luminance", "mean")
+
+# Header of the frames sent to /capture_raw: width and height (uint16), epoch
+# (float64, 0 if unknown) and step (uint32), little endian. The header is followed
+# by the height * width uint8 grayscale pixels in row-major order.
+RAW_FRAME_HEADER = struct.Struct("<HHdI")
+
+
+def decode_image(contents: bytes, grayscale: str = "luminance") -> np.ndarray:
+    """Decode an encoded image into a grayscale array.
+
+    Args:
+        contents: Encoded image, e.g. PNG or JPEG.
+        grayscale: "luminance" converts to a uint8 image with PIL, ignoring any
+            alpha channel. For the gray images of the ultrasound probe this equals
+            the mean of the color channels. "mean" averages all channels
+            (including alpha) into a float64 image.
+
+    Returns:
+        The (height, width) grayscale image.
+    """
+    image = Image.open(io.BytesIO(contents))
+    if grayscale == "luminance":
+        return np.asarray(image.convert("L"))
+    return np.mean(np.array(image), axis=2)
+
+
+def encode_raw_frame(image: np.ndarray, epoch: float = 0.0, step: int = 0) -> bytes:
+    """Encode a uint8 grayscale image as a frame for /capture_raw.
+
+    Args:
+        image: The (height, width) uint8 image.
+        epoch: Time the image was captured, in seconds since the Unix epoch. Only
+            set it if the clock of the sender is synchronized with the tracker.
+        step: Step number of the image.
+
+    Returns:
+        The header followed by the pixels.
+    """
+    height, width = image.shape
+    header = RAW_FRAME_HEADER.pack(width, height, epoch, step)
+    return header + np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+
+
+def decode_raw_frame(contents: bytes) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """Decode a frame sent to /capture_raw, see RAW_FRAME_HEADER.
+
+    Returns:
+        A read-only view of the pixels in contents, without copying them, and
+        the "step" and, if it was set, the "epoch" of the frame.
+
+    Raises:
+        ValueError: If the size of contents doesn't match the header.
+    """
+    if len(contents) < RAW_FRAME_HEADER.size:
+        raise ValueError(f"Raw frame is too short ({len(contents)} bytes)")
+    width, height, epoch, step = RAW_FRAME_HEADER.unpack_from(contents)
+    num_pixels = width * height
+    if len(contents) != RAW_FRAME_HEADER.size + num_pixels:
+        raise ValueError(
+            f"Raw frame of {width}x{height} pixels has "
+            f"{len(contents) - RAW_FRAME_HEADER.size} bytes of pixel data"
+        )
+    image = np.frombuffer(
+        contents, dtype=np.uint8, count=num_pixels, offset=RAW_FRAME_HEADER.size
+    ).reshape(height, width)
+    metadata = {"step": step}
+    if epoch > 0:
+        metadata["epoch"] = epoch
+    return image, metadata
+
 
 class ImageServer:
-    def __init__(self):
+    def __init__(
+        self,
+        max_queue_size=1,
+        overflow_policy="drop_oldest",
+        grayscale="luminance",
+        decode_workers=2,
+    ):
+        """Initialize the server.
+
+        Captured images are queued until they are retrieved with get_next_image.
+
+        Args:
+            max_queue_size: Maximum number of images in the queue.
+            overflow_policy: What to do with a capture when the queue is full.
+                "drop_oldest" removes the oldest queued image, "drop_newest"
+                discards the new image and "block" refuses the capture with HTTP
+                429, so the client can retry later. The default of a single
+                image with "drop_oldest" always serves the latest capture.
+            grayscale: How captures are converted to grayscale when they are
+                decoded, see decode_image.
+            decode_workers: Number of threads decoding the captured images. The
+                capture endpoint only queues the encoded image, so the event loop
+                is not blocked by decoding large images. With 0, images are
+                decoded on the event loop before they are queued.
+
+        Raises:
+            ValueError: If max_queue_size is smaller than 1, decode_workers is
+                negative or overflow_policy or grayscale is unknown.
+        """
+        if max_queue_size < 1:
+            raise ValueError(f"max_queue_size must be at least 1, got {max_queue_size}")
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow_policy: {overflow_policy}")
+        if grayscale not in GRAYSCALE_MODES:
+            raise ValueError(f"Unknown grayscale mode: {grayscale}")
+        if decode_workers < 0:
+            raise ValueError(f"decode_workers must be >= 0, got {decode_workers}")
         self.app = FastAPI()
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.grayscale = grayscale
+        self.decode_workers = decode_workers
+        self._decode_executor = None
         self._lock = threading.Lock()
-        self._event = threading.Event()
-        self._current_probe_data = None
+        self._frame_available = threading.Condition(self._lock)
+        self._queue = collections.deque()
+        self._counters = collections.Counter()
         self._server = None
         self._server_thread = None
 
@@ -34,8 +155,9 @@ class ImageServer:
 
         @self.app.post("/capture")
         async def capture(request: Request):
-            print("Capture endpoint called")
             current_time = time.time()
+            if self._reject_if_full():
+                return self._queue_full_response()
             try:
                 contents = None
                 content_type = request.headers.get("content-type", "").lower()
@@ -43,7 +165,9 @@ class ImageServer:
                 if content_type.startswith("multipart/form-data"):
                     form = await request.form()
                     file_upload = form.get("file")
-                    if not file_upload or not isinstance(file_upload, UploadFile):
+                    # Form fields are str, files are Starlette's UploadFile, which
+                    # is not an instance of FastAPI's UploadFile subclass
+                    if not file_upload or isinstance(file_upload, str):
                         print("No file uploaded in form")
                         return {"status": "error", "message": "No file uploaded"}
                     contents = await file_upload.read()
@@ -62,36 +186,114 @@ class ImageServer:
                         "message": f"Unsupported content type: {content_type}",
                     }
 
-                image = Image.open(io.BytesIO(contents))
-                image_array = np.array(image)
+                metadata = self._get_request_metadata(request)
+                metadata["epoch"] = current_time
 
-                metadata = {}
-                x_metadata = request.headers.get("x-metadata")
-                x_metadata_content_type = request.headers.get("x-metadata-content-type")
-                print(f"X-Metadata: {x_metadata}")
-                print(f"X-Metadata-Content-Type: {x_metadata_content_type}")
-                if x_metadata and x_metadata_content_type == "application/json":
-                    try:
-                        metadata = json.loads(x_metadata)
-                    except json.JSONDecodeError:
-                        metadata = {
-                            "error": "Invalid X-Metadata format",
-                            "raw": x_metadata,
-                        }
+                status = self._enqueue(self._decode(contents), metadata)
+                if status == "rejected":
+                    return self._queue_full_response()
+                if status == "dropped":
+                    return {"status": "dropped", "message": "Queue full"}
+                return {"status": "success"}
+            except Exception as e:
+                print(f"Error in capture endpoint: {str(e)}")
+                return {"status": "error", "message": str(e)}
 
+        @self.app.post("/capture_raw")
+        async def capture_raw(request: Request):
+            """Capture an uncompressed frame, encoded with encode_raw_frame.
+
+            The frame is queued without decoding. The epoch in the frame header
+            takes precedence over the time the frame was received.
+            """
+            current_time = time.time()
+            if self._reject_if_full():
+                return self._queue_full_response()
+            try:
+                image, frame_metadata = decode_raw_frame(await request.body())
+                metadata = self._get_request_metadata(request)
                 metadata["epoch"] = current_time
+                metadata.update(frame_metadata)
 
-                with self._lock:
-                    self._current_probe_data = (image_array, metadata)
-                    self._event.set()
-                    print(f"New image captured: {self._current_probe_data}")
+                status = self._enqueue(image, metadata)
+                if status == "rejected":
+                    return self._queue_full_response()
+                if status == "dropped":
+                    return {"status": "dropped", "message": "Queue full"}
                 return {"status": "success"}
             except Exception as e:
-                print(f"Error in capture endpoint: {str(e)}")
+                print(f"Error in capture_raw endpoint: {str(e)}")
                 return {"status": "error", "message": str(e)}
 
+        @self.app.websocket("/stream")
+        async def stream(websocket: WebSocket):
+            """Capture a continuous stream of frames over one connection.
+
+            Each binary message is a frame encoded with encode_raw_frame. A text
+            message with a JSON object sets the metadata of the next frame. Every
+            frame is answered with a JSON message with its "step" and the
+            "status" of the capture, "rejected" if the queue is full and the
+            overflow policy is "block".
+            """
+            await websocket.accept()
+            with self._lock:
+                self._counters["stream_clients"] += 1
+            print("Stream client connected")
+            next_metadata = {}
+            try:
+                while True:
+                    message = await websocket.receive()
+                    if message["type"] == "websocket.disconnect":
+                        break
+                    if message.get("text") is not None:
+                        try:
+                            next_metadata = json.loads(message["text"])
+                        except json.JSONDecodeError:
+                            next_metadata = {
+                                "error": "Invalid metadata format",
+                                "raw": message["text"],
+                            }
+                        continue
+                    if message.get("bytes") is None:
+                        # Neither text nor a frame
+                        continue
+                    current_time = time.time()
+                    if self._reject_if_full():
+                        await websocket.send_json({"status": "rejected"})
+                        continue
+                    try:
+                        image, frame_metadata = decode_raw_frame(message["bytes"])
+                    except ValueError as e:
+                        await websocket.send_json(
+                            {"status": "error", "message": str(e)}
+                        )
+                        continue
+                    metadata = next_metadata
+                    next_metadata = {}
+                    metadata["epoch"] = current_time
+                    metadata.update(frame_metadata)
+                    status = self._enqueue(image, metadata)
+                    await websocket.send_json(
+                        {"status": status, "step": frame_metadata["step"]}
+                    )
+            finally:
+                with self._lock:
+                    self._counters["stream_clients"] -= 1
+                print("Stream client disconnected")
+
+        @self.app.get("/stats")
+        async def stats():
+            return self.get_stats()
+
     def start(self, host: str = "0.0.0.0", port: int = 3000):
-        config = uvicorn.Config(self.app, host=host, port=port, log_level="error")
+        # Compressing the frames streamed over WebSockets costs more than it saves
+        config = uvicorn.Config(
+            self.app,
+            host=host,
+            port=port,
+            log_level="error",
+            ws_per_message_deflate=False,
+        )
         self._server = uvicorn.Server(config)
         self._server_thread = threading.Thread(target=self._server.run)
         self._server_thread.daemon = True
@@ -106,11 +308,167 @@ class ImageServer:
             self._server = None
             self._server_thread = None
             print("ImageServer stopped.")
+        if self._decode_executor is not None:
+            # Cancel the decoding of queued images that hasn't started yet.
+            # shutdown(cancel_futures=True) needs Python 3.9.
+            with self._lock:
+                for image, _ in self._queue:
+                    if isinstance(image, concurrent.futures.Future):
+                        image.cancel()
+            self._decode_executor.shutdown(wait=False)
+            self._decode_executor = None
+
+    def get_next_image(
+        self, on_dequeue: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """Wait for the oldest queued image and remove it from the queue.
+
+        Images that can't be decoded are skipped.
+
+        Args:
+            on_dequeue: Called with the metadata of the image as soon as it is
+                taken from the queue, before waiting for it to be decoded, e.g.
+                to request its pose in the meantime. Called again if the image
+                is skipped.
+
+        Returns:
+            The grayscale image (uint8 unless grayscale is "mean") and its
+            metadata. The metadata contains the "epoch" the capture was received
+            at and the "enqueue_time" and "dequeue_time" of the image.
+        """
+        while True:
+            with self._frame_available:
+                self._frame_available.wait_for(lambda: len(self._queue) > 0)
+                image, metadata = self._queue.popleft()
+                self._counters["dequeued"] += 1
+            if on_dequeue is not None:
+                on_dequeue(metadata)
+            if isinstance(image, concurrent.futures.Future):
+                try:
+                    image = image.result()
+                except Exception as e:
+                    print(f"Error decoding image: {str(e)}")
+                    with self._lock:
+                        self._counters["decode_errors"] += 1
+                    continue
+            metadata["dequeue_time"] = time.time()
+            return image, metadata
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the queue depth and the counts of received and dropped images.
 
-    def get_next_image(self) -> Tuple[np.ndarray, Dict[str, Any]]:
-        self._event.wait()
+        Returns:
+            "queue_depth" is the number of images waiting in the queue. "received"
+            counts all capture requests, "enqueued" and "dequeued" the images
+            added to and taken from the queue. Images dropped because the queue
+            was full are counted in "dropped_oldest" and "dropped_newest",
+            captures refused with HTTP 429 in "rejected" and images that
+            couldn't be decoded in "decode_errors". "stream_clients" is the
+            number of connections to /stream.
+        """
         with self._lock:
-            image_data = self._current_probe_data
-            self._current_probe_data = None
-            self._event.clear()
-        return np.mean(image_data[0], axis=2), image_data[1]
+            stats = {
+                "queue_depth": len(self._queue),
+                "max_queue_size": self.max_queue_size,
+                "stream_clients": self._counters["stream_clients"],
+                "overflow_policy": self.overflow_policy,
+            }
+            for name in (
+                "received",
+                "enqueued",
+                "dequeued",
+                "dropped_oldest",
+                "dropped_newest",
+                "rejected",
+                "decode_errors",
+            ):
+                stats[name] = self._counters[name]
+        return stats
+
+    def _get_request_metadata(self, request: Request) -> Dict[str, Any]:
+        """Get the metadata of a capture from its X-Metadata header."""
+        metadata = {}
+        x_metadata = request.headers.get("x-metadata")
+        x_metadata_content_type = request.headers.get("x-metadata-content-type")
+        if x_metadata and x_metadata_content_type == "application/json":
+            try:
+                metadata = json.loads(x_metadata)
+            except json.JSONDecodeError:
+                metadata = {
+                    "error": "Invalid X-Metadata format",
+                    "raw": x_metadata,
+                }
+        return metadata
+
+    def _reject_if_full(self) -> bool:
+        """Count a received capture and check if it must be refused right away.
+
+        Returns:
+            True if the queue is full and the overflow policy is "block".
+        """
+        with self._lock:
+            self._counters["received"] += 1
+            if self._is_full() and self.overflow_policy == "block":
+                self._counters["rejected"] += 1
+                return True
+        return False
+
+    def _decode(self, contents: bytes):
+        """Decode an image, or start decoding it on a worker thread.
+
+        Returns:
+            The image, or a future of it if decode_workers > 0.
+        """
+        if self.decode_workers == 0:
+            return decode_image(contents, self.grayscale)
+        if self._decode_executor is None:
+            self._decode_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.decode_workers, thread_name_prefix="ImageDecoder"
+            )
+        return self._decode_executor.submit(decode_image, contents, self.grayscale)
+
+    def _enqueue(self, image, metadata: Dict[str, Any]) -> str:
+        """Add an image to the queue, applying the overflow policy if it is full.
+
+        Args:
+            image: The image or a future of it.
+            metadata: Metadata of the image. Gets the "enqueue_time".
+
+        Returns:
+            "success" if the image was queued, "dropped" if it was dropped and
+            "rejected" if it was refused because the queue is full.
+        """
+        with self._lock:
+            if self._is_full():
+                if self.overflow_policy == "block":
+                    self._counters["rejected"] += 1
+                    return "rejected"
+                if self.overflow_policy == "drop_newest":
+                    self._counters["dropped_newest"] += 1
+                    # Counted in /stats, so don't report every frame
+                    logger.debug("Image queue full, dropped new image")
+                    if isinstance(image, concurrent.futures.Future):
+                        image.cancel()
+                    return "dropped"
+                dropped_image, _ = self._queue.popleft()
+                if isinstance(dropped_image, concurrent.futures.Future):
+                    dropped_image.cancel()
+                self._counters["dropped_oldest"] += 1
+                logger.debug("Image queue full, dropped oldest image")
+            metadata["enqueue_time"] = time.time()
+            self._queue.append((image, metadata))
+            self._counters["enqueued"] += 1
+            self._frame_available.notify()
+            logger.debug("New image captured: %s", metadata)
+        return "success"
+
+    def _is_full(self) -> bool:
+        return len(self._queue) >= self.max_queue_size
+
+    def _queue_full_response(self) -> JSONResponse:
+        logger.debug("Image queue full, rejected capture")
+        return JSONResponse(
+            status_code=429,
+            content={"status": "error", "message": "Queue full"},
+            headers={"Retry-After": "1"},
+        )
@@ -0,0 +1,242 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""HTTP client for the pose endpoints of the Vive tracker server.
+
+The TrackerClient keeps its connections to scripts/htc_vive/server.py open
+between requests, so a pose request costs one round trip instead of a new TCP
+connection each time. Failed connections and 502/503/504 responses are retried
+with exponential backoff, and the latencies of all requests are counted in a
+histogram.
+"""
+
+import concurrent.futures
+import io
+import threading
+import time
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Upper bucket edges of the latency histogram, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class LatencyHistogram:
+    """Thread-safe histogram of request latencies."""
+
+    def __init__(self, bucket_edges_ms=LATENCY_BUCKETS_MS):
+        self.bucket_edges_ms = tuple(bucket_edges_ms)
+        self._lock = threading.Lock()
+        # The last bucket counts latencies above the last edge
+        self._counts = [0] * (len(self.bucket_edges_ms) + 1)
+        self._total_ms = 0.0
+        self._max_ms = 0.0
+
+    def add(self, seconds):
+        latency_ms = seconds * 1000.0
+        bucket = int(np.searchsorted(self.bucket_edges_ms, latency_ms, side="left"))
+        with self._lock:
+            self._counts[bucket] += 1
+            self._total_ms += latency_ms
+            self._max_ms = max(self._max_ms, latency_ms)
+
+    def get_stats(self):
+        """Get the number, mean and maximum of the latencies and the bucket counts.
+
+        Returns:
+            dict: "count", "mean_ms", "max_ms" and "buckets", the number of
+                latencies up to each edge (e.g. "<=5ms") and above the last one.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total_ms, max_ms = self._total_ms, self._max_ms
+        count = sum(counts)
+        labels = [f"<={edge}ms" for edge in self.bucket_edges_ms]
+        labels.append(f">{self.bucket_edges_ms[-1]}ms")
+        return {
+            "count": count,
+            "mean_ms": total_ms / count if count else 0.0,
+            "max_ms": max_ms,
+            "buckets": dict(zip(labels, counts)),
+        }
+
+
+class TrackerClient:
+    """Requests poses from the Vive tracker server over persistent connections."""
+
+    def __init__(
+        self,
+        pose_url,
+        connect_timeout=1.0,
+        read_timeout=0.5,
+        retries=2,
+        backoff_factor=0.05,
+        pool_size=4,
+    ):
+        """Initialize the client.
+
+        Args:
+            pose_url: URL of the /pose endpoint of the tracker server. /poses is
+                expected next to it.
+            connect_timeout: Seconds to wait for a connection to the server.
+            read_timeout: Seconds to wait for a response once connected.
+            retries: Number of times a failed request is retried.
+            backoff_factor: The nth retry waits backoff_factor * 2 ** (n - 1)
+                seconds.
+            pool_size: Number of connections kept open, i.e. of concurrent
+                requests that don't need a new connection.
+
+        Raises:
+            ValueError: If a timeout is not positive or retries is negative.
+        """
+        if not (connect_timeout > 0 and read_timeout > 0):
+            raise ValueError(
+                f"Timeouts must be positive, got {connect_timeout} and {read_timeout}"
+            )
+        if retries < 0:
+            raise ValueError(f"retries must not be negative, got {retries}")
+        self.pose_url = pose_url
+        self.poses_url = pose_url.rsplit("/", 1)[0] + "/poses"
+        self.stats_url = pose_url.rsplit("/", 1)[0] + "/stats"
+        self.timeout = (connect_timeout, read_timeout)
+        self.latencies = LatencyHistogram()
+        self.num_failures = 0
+        self._lock = threading.Lock()
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            # /poses requests are POSTs, but don't change anything either
+            allowed_methods=frozenset(["GET", "POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = None
+
+    def get_pose(self, epoch=None):
+        """Get the pose at a time from /pose.
+
+        Args:
+            epoch: Time in seconds since the Unix epoch, None for the newest pose.
+
+        Returns:
+            The "data" of the response, or None if the request failed.
+        """
+        params = None if epoch is None else {"epoch": epoch}
+        response = self._request("GET", self.pose_url, params=params)
+        if response is None:
+            return None
+        try:
+            return response.json()["data"]
+        except (ValueError, KeyError):
+            self._count_failure()
+            return None
+
+    def get_pose_async(self, epoch=None):
+        """Start getting a pose on a background thread.
+
+        Returns:
+            concurrent.futures.Future: Future of the result of get_pose.
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="TrackerClient"
+            )
+        return self._executor.submit(self.get_pose, epoch)
+
+    def get_poses(self, params):
+        """Get the poses at many times with one POST to /poses.
+
+        Args:
+            params: The JSON request, see scripts/htc_vive/server.py.
+
+        Returns:
+            The POSE_RECORD_DTYPE records, or None if the request failed.
+        """
+        response = self._request(
+            "POST", self.poses_url, json=dict(params, format="npy")
+        )
+        if response is None:
+            return None
+        try:
+            return np.load(io.BytesIO(response.content), allow_pickle=False)
+        except ValueError:
+            self._count_failure()
+            return None
+
+    def estimate_clock_offset(self, num_requests=5):
+        """Estimate how far the clock of the tracker server is ahead of this one.
+
+        Reads the server "time" from /stats and assumes it was taken halfway
+        through the request. The estimate of the fastest of num_requests
+        requests is used, so it is off by at most half its round trip time.
+
+        Returns:
+            float: Seconds to add to a time.time() of this computer to get the
+                time on the tracker server, or None if no request succeeded.
+        """
+        best_offset, best_round_trip = None, None
+        for _ in range(num_requests):
+            start = time.time()
+            response = self._request("GET", self.stats_url)
+            end = time.time()
+            if response is None:
+                # The server is not reachable, don't wait for the other requests
+                break
+            try:
+                server_time = float(response.json()["time"])
+            except (ValueError, KeyError, TypeError):
+                self._count_failure()
+                continue
+            if best_round_trip is None or end - start < best_round_trip:
+                best_offset = server_time - (start + end) / 2
+                best_round_trip = end - start
+        return best_offset
+
+    def get_stats(self):
+        """Get the latency statistics of all requests and the number of failures."""
+        with self._lock:
+            num_failures = self.num_failures
+        return dict(self.latencies.get_stats(), failures=num_failures)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.session.close()
+
+    def _request(self, method, url, **kwargs):
+        """Send a request, returning the response or None if it failed."""
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            print(f"Request to {url} failed: {e}")
+            self._count_failure()
+            return None
+        finally:
+            self.latencies.add(time.perf_counter() - start)
+        if not response.ok:
+            print(f"Request to {url} failed: {response.status_code} {response.text}")
+            self._count_failure()
+            return None
+        return response
+
+    def _count_failure(self):
+        with self._lock:
+            self.num_failures += 1
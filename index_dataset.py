@@ -0,0 +1,44 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Build the index of ultrasound datasets.
+
+Writes an index.json listing the scenes, their number of steps, step files or
+frame offsets, image shapes and pose ranges (see custom_classes/dataset_index.py)
+into each given dataset directory, e.g.
+
+    python index_dataset.py ~/tbp/data/ultrasound_test_set/demo_object_spam
+
+Afterwards, set "use_dataset_index": True in the experiment's env_init_args.
+Rebuild the index whenever scenes or steps are added to the dataset.
+"""
+
+import argparse
+import time
+
+from custom_classes.dataset_index import build_dataset_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("data_paths", nargs="+", help="Dataset directories to index.")
+    args = parser.parse_args()
+
+    for data_path in args.data_paths:
+        start_time = time.time()
+        index = build_dataset_index(data_path)
+        num_steps = sum(scene["num_steps"] for scene in index["scenes"])
+        print(
+            f"Indexed {len(index['scenes'])} scenes with {num_steps} steps in "
+            f"{data_path} in {time.time() - start_time:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
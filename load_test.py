@@ -0,0 +1,190 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Load test the online experiment setup without the iPad, probe and tracker.
+
+Replays a recorded dataset (a directory with {step}.json files or an episode
+file, random images if none is given): the frames are sent to the image server at
+a fixed rate, and their recorded poses are served on /pose like the Vive tracker
+server does. Run the experiment against it, e.g.
+
+    python run.py -e probe_triggered_load_test_experiment
+    python load_test.py ~/tbp/data/ultrasound_test_set/demo_object_spam --rate 20
+
+or pass --run_environment to step a ProbeTriggeredUltrasoundEnvironment in this
+process instead of running Monty. At the end, the sustained frame rates and the
+latencies of sending the frames and until the environment took them are reported.
+"""
+
+import argparse
+import json
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from custom_classes.fake_devices import (
+    FRAME_FORMATS,
+    FakeTrackerServer,
+    FramePoster,
+    RecordedFrameSource,
+    SyntheticFrameSource,
+    summarize_latencies,
+)
+
+
+def start_environment(capture_url, tracker_port):
+    """Step a ProbeTriggeredUltrasoundEnvironment on a background thread."""
+    # Only import the environment (and with it Monty) if it is used
+    from custom_classes.probe_triggered_environment import (
+        ProbeTriggeredUltrasoundEnvironment,
+    )
+
+    environment = ProbeTriggeredUltrasoundEnvironment(
+        image_listen_port=urllib.parse.urlparse(capture_url).port,
+        vive_url=f"http://localhost:{tracker_port}/pose",
+    )
+
+    def step_forever():
+        while True:
+            environment.step(None)
+
+    threading.Thread(target=step_forever, name="Environment", daemon=True).start()
+
+    # The image server starts on a background thread
+    stats_url = capture_url.rsplit("/", 1)[0] + "/stats"
+    deadline = time.monotonic() + 10.0
+    while time.monotonic() < deadline:
+        try:
+            requests.get(stats_url, timeout=1.0)
+            break
+        except requests.RequestException:
+            time.sleep(0.1)
+    return environment
+
+
+def print_latencies(title, latencies):
+    summary = summarize_latencies(latencies)
+    if summary["count"] == 0:
+        print(f"{title}: no frames")
+        return
+    print(
+        f"{title} (ms): mean {summary['mean']:.1f}, p50 {summary['p50']:.1f}, "
+        f"p90 {summary['p90']:.1f}, p99 {summary['p99']:.1f}, "
+        f"max {summary['max']:.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "data_path",
+        nargs="?",
+        default=None,
+        help="JSON dataset directory or episode file to replay. Random images if "
+        "not given.",
+    )
+    parser.add_argument(
+        "--capture_url",
+        default="http://localhost:3000/capture",
+        help="URL of the /capture endpoint of the image server.",
+    )
+    parser.add_argument(
+        "--tracker_port",
+        type=int,
+        default=3001,
+        help="Port to serve the poses on.",
+    )
+    parser.add_argument("--rate", type=float, default=10.0, help="Frames per second.")
+    parser.add_argument(
+        "--duration", type=float, default=30.0, help="Seconds to send frames for."
+    )
+    parser.add_argument(
+        "--format",
+        choices=FRAME_FORMATS,
+        default="png",
+        help="png: PNG files to /capture like the iPad app. raw: uncompressed "
+        "frames to /capture_raw.",
+    )
+    parser.add_argument(
+        "--run_environment",
+        action="store_true",
+        help="Step a ProbeTriggeredUltrasoundEnvironment in this process.",
+    )
+    parser.add_argument(
+        "--drain_time",
+        type=float,
+        default=2.0,
+        help="Seconds to wait for the last frames to be taken after sending.",
+    )
+    args = parser.parse_args()
+
+    if args.data_path is None:
+        frame_source = SyntheticFrameSource()
+    else:
+        frame_source = RecordedFrameSource(args.data_path)
+    print(f"Replaying {len(frame_source)} frames")
+
+    tracker = FakeTrackerServer(port=args.tracker_port)
+    tracker.start()
+    if args.run_environment:
+        start_environment(args.capture_url, args.tracker_port)
+    poster = FramePoster(
+        frame_source,
+        capture_url=args.capture_url,
+        tracker=tracker,
+        rate=args.rate,
+        frame_format=args.format,
+    )
+    try:
+        start_time = time.monotonic()
+        results = poster.run(duration=args.duration)
+        send_duration = time.monotonic() - start_time
+        time.sleep(args.drain_time)
+    except KeyboardInterrupt:
+        print("\nKeyboard interrupt received, stopping...")
+        return
+    finally:
+        poster.close()
+        tracker.stop()
+
+    statuses = {}
+    for result in results:
+        statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+    print(
+        f"Sent {len(results)} frames in {send_duration:.1f}s: "
+        f"{len(results) / send_duration:.1f} fps (target {args.rate} fps), {statuses}"
+    )
+    print_latencies("Capture request latency", [r["latency"] for r in results])
+
+    pickup_times = tracker.get_pickup_times()
+    print(
+        f"The environment took {len(pickup_times)} frames: "
+        f"{len(pickup_times) / send_duration:.1f} fps"
+    )
+    print_latencies(
+        "Latency from sending to taking a frame",
+        [
+            pickup_time - results[frame]["send_time"]
+            for frame, pickup_time in pickup_times.items()
+            if frame < len(results)
+        ],
+    )
+
+    stats_url = args.capture_url.rsplit("/", 1)[0] + "/stats"
+    try:
+        stats = requests.get(stats_url, timeout=2.0).json()
+        print(f"Image server stats: {json.dumps(stats)}")
+    except (requests.RequestException, ValueError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
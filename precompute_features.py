@@ -0,0 +1,134 @@
+# Copyright 2025 Thousand Brains Project
+#
+# Copyright may exist in Contributors' modifications
+# and/or contributions to the work.
+#
+# Use of this source code is governed by the MIT
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""Precompute the patches and sensor module features of JSON datasets.
+
+Walks the {step}.json files of a dataset once, searches the patch, extracts the
+edge points, fits the circles and stores everything together with the poses in
+a feature sidecar next to the JSON files (see custom_classes/feature_sidecar.py).
+The patch size and sensor module settings are taken from the given experiment,
+e.g.
+
+    python precompute_features.py -e json_dataset_ultrasound_experiment
+
+Afterwards, set "use_feature_sidecar": True in the experiment's env_init_args to
+read the features from the sidecar.
+"""
+
+import argparse
+import time
+
+from tbp.monty.frameworks.run_env import setup_env
+
+setup_env()
+
+import numpy as np  # noqa: E402
+
+from configs import CONFIGS  # noqa: E402
+from custom_classes.environment import JSONDatasetUltrasoundEnvironment  # noqa: E402
+from custom_classes.feature_sidecar import save_feature_sidecar  # noqa: E402
+from custom_classes.patch_search import (  # noqa: E402
+    find_patch_with_highest_gradient,
+)
+
+
+def precompute_features(data_path, sensor_module, patch_size, **patch_search_args):
+    """Create the feature sidecar of one JSON dataset.
+
+    Args:
+        data_path: Dataset directory containing the {step}.json files.
+        sensor_module: UltrasoundSM used to extract the features.
+        patch_size: Size of the patches to extract.
+        **patch_search_args: patch_search method passed on to
+            find_patch_with_highest_gradient.
+
+    Returns:
+        str: Path of the written sidecar.
+
+    Raises:
+        ValueError: If the dataset contains no data points.
+    """
+    env = JSONDatasetUltrasoundEnvironment(data_path)
+    patches, patch_pixel_starts, full_image_heights, states = [], [], [], []
+    while env.step(None) is not None:
+        patch, patch_pixel_start = find_patch_with_highest_gradient(
+            env.full_image, patch_size, **patch_search_args
+        )
+        patches.append(patch)
+        patch_pixel_starts.append(patch_pixel_start)
+        full_image_heights.append(env.full_image.shape[0])
+        states.append(env.get_state())
+    if not patches:
+        raise ValueError(f"No data points found in {data_path}")
+
+    patches = np.array(patches).reshape(-1, patch_size, patch_size)
+    sensor_module.pre_episode()
+    normals, curvatures, pixel_depths, fit_details = (
+        sensor_module.extract_patch_pose_feat_batch(patches, return_fit_details=True)
+    )
+    return save_feature_sidecar(
+        data_path,
+        patch_size,
+        sensor_module.get_feature_settings_key(patches.shape[1:]),
+        patches,
+        patch_pixel_starts,
+        full_image_heights,
+        dict(
+            normals=normals,
+            curvatures=curvatures,
+            pixel_depths=pixel_depths,
+            **fit_details,
+        ),
+        states,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "-e",
+        "--experiment",
+        required=True,
+        help="Experiment to take the dataset, patch size and sensor module from.",
+    )
+    parser.add_argument(
+        "data_paths",
+        nargs="*",
+        help="Dataset directories to process instead of the experiment's dataset.",
+    )
+    args = parser.parse_args()
+
+    config = CONFIGS[args.experiment]
+    data_paths = args.data_paths or [
+        config["dataset_args"]["env_init_args"]["data_path"]
+    ]
+    dataloader_args = config["eval_dataloader_args"]
+    patch_search_args = {
+        key: dataloader_args[key] for key in ("patch_search",) if key in dataloader_args
+    }
+
+    sm_config = config["monty_config"]["sensor_module_configs"]["sensor_module_0"]
+    sm_args = dict(sm_config["sensor_module_args"])
+    # Features are written to the sidecar, not to the feature cache
+    sm_args.pop("feature_cache_dir", None)
+    sensor_module = sm_config["sensor_module_class"](**sm_args)
+
+    for data_path in data_paths:
+        start_time = time.time()
+        sidecar_path = precompute_features(
+            data_path,
+            sensor_module,
+            dataloader_args["patch_size"],
+            **patch_search_args,
+        )
+        print(f"Wrote {sidecar_path} in {time.time() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
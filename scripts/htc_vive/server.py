@@ -2,9 +2,38 @@
 """
 Pose logger for a VIVE Tracker 3.0 (no HMD).
 Provides pose via HTTP endpoint (quaternion and position).
+
+GET /pose returns the latest pose. GET /pose?epoch=<seconds since the Unix epoch>
+returns the pose at that time, interpolated between the recorded samples. The
+epoch must be on the clock of this computer, see /stats.
+
+/poses returns the poses at many times in one response. The times are given as
+epochs=<comma separated list> or as start=<epoch>&end=<epoch>&stride=<seconds>,
+either as query parameters of a GET request or as a JSON object in the body of a
+POST request (with epochs as a list). With format=npy, the poses are sent as a
+.npy file of POSE_RECORD_DTYPE records instead of JSON.
+
+GET /pose_stream keeps the connection open and pushes every new sample as a
+STREAM_RECORD_DTYPE record (65 bytes, little endian, no delimiters). With
+backlog=<number of samples>, it first sends up to that many past samples.
+
+GET /stats returns the sampler settings, the measured intervals between the
+recent samples and the current "time" on the clock the samples are stamped with,
+so clients can estimate the offset to their own clock.
+
+The tracker is sampled at a fixed rate (--rate, 100 Hz by default). Samples are
+stamped with time.monotonic() plus an offset to the Unix epoch measured at start.
+--source fake or --source replay --replay_file <poses.npy> replace OpenVR, to run
+the server without SteamVR or a tracker, e.g. on Linux. Run with --help for all
+options.
 """
 
+import argparse
+import ctypes
+import io
 import json
+import math
+import os
 import sys
 import threading
 import time
@@ -13,22 +42,339 @@ from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 
 import numpy as np
-import openvr
 from scipy.spatial.transform import Rotation
 
-# Global variable to store the latest pose data and a lock for thread-safe access
-latest_pose_data = {
-    "timestamp": 0.0,
-    "pose_matrix": None,
-    "is_valid": False,
-    "serial_number": "",
+try:
+    import openvr
+except ImportError:
+    # Only needed for the OpenVR pose source
+    openvr = None
+
+# The record formats are shared with the clients. custom_classes.pose_records only
+# needs numpy, so the rest of Monty doesn't have to be installed on this computer.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from custom_classes.pose_records import (  # noqa: E402
+    POSE_RECORD_DTYPE,
+    STREAM_RECORD_DTYPE,
+)
+
+# Number of samples kept for looking up past poses, 60 s at 100 Hz
+POSE_HISTORY_SIZE = 6000
+# Seconds of past poses kept, the history size is adjusted to the sampling rate
+POSE_HISTORY_SECONDS = 60.0
+SAMPLING_SCHEDULES = ("fixed", "sleep")
+# Seconds before the next sample time at which to stop sleeping and wait actively
+SLEEP_MARGIN = 0.001
+# Number of recent samples the sampling intervals in /stats are computed from
+STATS_NUM_SAMPLES = 1000
+
+# Serial number of the tracker, and a lock for thread-safe access to it and to the
+# cached /pose response
+tracker_info = {"serial_number": ""}
+# Settings of the ViveTrackerThread and number of samples it was too late for
+sampler_info = {
+    "source": "",
+    "rate": 0.0,
+    "prediction": 0.0,
+    "schedule": "",
+    "missed_samples": 0,
+    # Added to time.monotonic() to get the timestamps of the samples
+    "epoch_offset": time.time() - time.monotonic(),
 }
 pose_lock = threading.Lock()
 shutdown_event = threading.Event()
 
 
+# Maximum number of poses returned by one /poses request
+MAX_POSES_PER_REQUEST = 100000
+# Default time between the poses requested with start and end
+DEFAULT_POSES_STRIDE = 0.01
+
+
+def slerp(quats_0, quats_1, fractions):
+    """Spherically interpolate between pairs of unit quaternions.
+
+    Args:
+        quats_0: (N, 4) quaternions at fraction 0.
+        quats_1: (N, 4) quaternions at fraction 1, in the same component order.
+        fractions: (N,) interpolation fractions.
+
+    Returns:
+        np.ndarray: (N, 4) interpolated unit quaternions.
+    """
+    dots = np.sum(quats_0 * quats_1, axis=1)
+    # Take the shorter way around
+    quats_1 = np.where(dots[:, None] < 0, -quats_1, quats_1)
+    angles = np.arccos(np.clip(np.abs(dots), 0.0, 1.0))
+    sines = np.sin(angles)
+    # Fall back to linear interpolation for (almost) equal rotations
+    is_small = sines < 1e-6
+    safe_sines = np.where(is_small, 1.0, sines)
+    weights_0 = np.where(
+        is_small, 1 - fractions, np.sin((1 - fractions) * angles) / safe_sines
+    )
+    weights_1 = np.where(is_small, fractions, np.sin(fractions * angles) / safe_sines)
+    quats = weights_0[:, None] * quats_0 + weights_1[:, None] * quats_1
+    return quats / np.linalg.norm(quats, axis=1, keepdims=True)
+
+
+class PoseHistory:
+    """Fixed-size ring buffer of timestamped tracker poses.
+
+    The position and quaternion of each sample are computed once when it is
+    added, so lookups and streaming don't convert rotation matrices.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._records = np.zeros(size, dtype=STREAM_RECORD_DTYPE)
+        # Index the next sample is written to, and number of stored samples
+        self._next = 0
+        self._count = 0
+        # Number of samples appended since the start
+        self._num_appended = 0
+        self._lock = threading.Lock()
+        self._sample_added = threading.Condition(self._lock)
+
+    @property
+    def num_appended(self):
+        with self._lock:
+            return self._num_appended
+
+    def append(self, timestamp, pose_matrix, is_valid):
+        """Add a sample, overwriting the oldest one if the buffer is full.
+
+        Args:
+            timestamp: Time of the sample in seconds since the Unix epoch. Must be
+                increasing.
+            pose_matrix: 3x4 pose matrix of the tracker (array-like).
+            is_valid: Whether the pose is valid.
+        """
+        position = None
+        quat_xyzw = None
+        if is_valid:
+            pose_matrix = np.asarray(pose_matrix, dtype=float)
+            position = pose_matrix[:, 3]
+            quat_xyzw = Rotation.from_matrix(pose_matrix[:, :3]).as_quat()
+        with self._lock:
+            record = self._records[self._next]
+            record["timestamp"] = timestamp
+            record["valid"] = is_valid
+            if is_valid:
+                record["position"] = position
+                record["rotation"] = quat_xyzw[[3, 0, 1, 2]]
+            else:
+                record["position"] = 0.0
+                record["rotation"] = 0.0
+            self._next = (self._next + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+            self._num_appended += 1
+            self._sample_added.notify_all()
+
+    def get_sample_intervals(self, max_samples):
+        """Get the times between the newest samples, up to max_samples of them."""
+        with self._lock:
+            num_samples = min(self._count, max_samples)
+            indices = np.arange(self._next - num_samples, self._next) % self.size
+            timestamps = self._records["timestamp"][indices]
+        return np.diff(timestamps)
+
+    def get_newest(self):
+        """Get the newest sample.
+
+        Returns:
+            tuple: (num_appended, record). The STREAM_RECORD_DTYPE record of the
+                newest sample, None if there are no samples, and the number of
+                samples appended so far, which identifies the sample.
+        """
+        with self._lock:
+            if self._count == 0:
+                return self._num_appended, None
+            return self._num_appended, self._records[self._next - 1].copy()
+
+    def get_samples_since(self, num_seen, timeout=None):
+        """Wait for samples appended after the first num_seen ones.
+
+        Args:
+            num_seen: Number of appended samples the caller has already seen.
+            timeout: Maximum number of seconds to wait, None to wait forever.
+
+        Returns:
+            tuple: (records, num_appended). STREAM_RECORD_DTYPE records of the
+                new samples that are still in the buffer, possibly none after a
+                timeout, and the number of samples appended so far.
+        """
+        with self._sample_added:
+            self._sample_added.wait_for(
+                lambda: self._num_appended > num_seen, timeout=timeout
+            )
+            num_new = min(self._num_appended - num_seen, self._count)
+            indices = (self._next - num_new + np.arange(num_new)) % self.size
+            return self._records[indices], self._num_appended
+
+    def get_pose_at(self, epoch):
+        """Get the pose at a time.
+
+        Between two samples, the position is interpolated linearly and the
+        rotation with slerp. After the newest sample, the newest pose is returned.
+
+        Args:
+            epoch: Time in seconds since the Unix epoch.
+
+        Returns:
+            tuple: (timestamp, position, quat_xyzw, interpolated), or None if
+                epoch is before the oldest sample or a sample used for it is not
+                valid. timestamp is epoch for interpolated poses and the time of
+                the newest sample otherwise.
+        """
+        poses = self.get_poses_at([epoch])
+        if not poses["valid"][0]:
+            return None
+        quat_wxyz = poses["rotation"][0]
+        quat_xyzw = np.array([quat_wxyz[1], quat_wxyz[2], quat_wxyz[3], quat_wxyz[0]])
+        interpolated = bool(poses["timestamp"][0] == epoch)
+        return poses["timestamp"][0], poses["position"][0], quat_xyzw, interpolated
+
+    def get_poses_at(self, epochs):
+        """Get the poses at many times at once, see get_pose_at.
+
+        Args:
+            epochs: Times in seconds since the Unix epoch.
+
+        Returns:
+            np.ndarray: Record array of POSE_RECORD_DTYPE. Poses that are not
+                available are marked as not valid and filled with zeros.
+        """
+        epochs = np.asarray(epochs, dtype=float).reshape(-1)
+        poses = np.zeros(len(epochs), dtype=POSE_RECORD_DTYPE)
+        poses["epoch"] = epochs
+        with self._lock:
+            if self._count == 0:
+                return poses
+            after = self._count_up_to(epochs)
+            found = after > 0
+            # After the newest sample, both neighbors are the newest sample
+            before = self._records[self._get_index(np.maximum(after - 1, 0))]
+            after = self._records[self._get_index(np.minimum(after, self._count - 1))]
+
+        valid = found & (before["valid"] > 0) & (after["valid"] > 0)
+        before, after, epochs = before[valid], after[valid], epochs[valid]
+        durations = after["timestamp"] - before["timestamp"]
+        fractions = np.zeros(len(epochs))
+        np.divide(
+            epochs - before["timestamp"], durations, out=fractions, where=durations > 0
+        )
+        positions = before["position"] + fractions[:, None] * (
+            after["position"] - before["position"]
+        )
+
+        poses["valid"] = valid
+        poses["timestamp"][valid] = np.where(durations > 0, epochs, after["timestamp"])
+        poses["position"][valid] = positions
+        poses["rotation"][valid] = slerp(
+            before["rotation"], after["rotation"], fractions
+        )
+        return poses
+
+    def _get_index(self, age_order):
+        """Get the buffer indices of samples by age order (0 = oldest)."""
+        return (self._next - self._count + age_order) % self.size
+
+    def _count_up_to(self, epochs):
+        """Count the samples at or before each epoch. The lock must be held."""
+        timestamps = self._records["timestamp"]
+        if self._count < self.size:
+            return np.searchsorted(timestamps[: self._count], epochs, side="right")
+        # The buffer is full, the samples from _next on are older than the others
+        older = np.searchsorted(timestamps[self._next :], epochs, side="right")
+        newer = np.searchsorted(timestamps[: self._next], epochs, side="right")
+        return np.where(newer > 0, self.size - self._next + newer, older)
+
+
+pose_history = PoseHistory(POSE_HISTORY_SIZE)
+
+# Serialized /pose response for the newest sample. It is built by the first
+# request for a sample and then handed out as is to all other clients.
+latest_pose_response = {"num_appended": -1, "status": 404, "body": b""}
+
+
+def get_latest_pose_response():
+    """Get the status and JSON body of the /pose response for the newest sample."""
+    num_appended, record = pose_history.get_newest()
+    with pose_lock:
+        if latest_pose_response["num_appended"] != num_appended:
+            if record is None or not record["valid"]:
+                status = 404
+                payload = {"error": "Tracker pose not available or invalid"}
+                if tracker_info["serial_number"]:
+                    payload["serial_number"] = tracker_info["serial_number"]
+            else:
+                status = 200
+                position = record["position"]
+                rotation = record["rotation"]
+                payload = {
+                    "data": {
+                        "timestamp": float(record["timestamp"]),
+                        "pose": {
+                            "position": {
+                                "x": float(position[0]),
+                                "y": float(position[1]),
+                                "z": float(position[2]),
+                            },
+                            "rotation": {
+                                "w": float(rotation[0]),
+                                "x": float(rotation[1]),
+                                "y": float(rotation[2]),
+                                "z": float(rotation[3]),
+                            },
+                        },
+                        "serial_number": tracker_info["serial_number"],
+                    }
+                }
+            latest_pose_response["num_appended"] = num_appended
+            latest_pose_response["status"] = status
+            latest_pose_response["body"] = json.dumps(payload).encode("utf-8")
+        return latest_pose_response["status"], latest_pose_response["body"]
+
+
+def get_requested_epochs(params):
+    """Get the epochs requested from /poses.
+
+    Args:
+        params: Dict with either "epochs" (list or comma separated string) or
+            "start", "end" and optionally "stride". The epochs from start to
+            end (exclusive) are stride seconds apart.
+
+    Returns:
+        np.ndarray: The requested epochs.
+
+    Raises:
+        ValueError: If the parameters are invalid or too many poses are requested.
+    """
+    if "epochs" in params:
+        epochs = params["epochs"]
+        if isinstance(epochs, str):
+            epochs = epochs.split(",") if epochs else []
+        epochs = np.asarray(epochs, dtype=float).reshape(-1)
+    elif "start" in params and "end" in params:
+        start = float(params["start"])
+        end = float(params["end"])
+        stride = float(params.get("stride", DEFAULT_POSES_STRIDE))
+        if not stride > 0:
+            raise ValueError(f"stride must be positive, got {stride}")
+        num_epochs = max(math.ceil((end - start) / stride), 0)
+        if num_epochs > MAX_POSES_PER_REQUEST:
+            raise ValueError(f"At most {MAX_POSES_PER_REQUEST} poses per request")
+        epochs = start + np.arange(num_epochs) * stride
+    else:
+        raise ValueError("Pass epochs, or start and end")
+    if len(epochs) > MAX_POSES_PER_REQUEST:
+        raise ValueError(f"At most {MAX_POSES_PER_REQUEST} poses per request")
+    return epochs
+
+
 # -----------------------------------------------------------------------------#
-# Helpers
+# Pose Sources
 # -----------------------------------------------------------------------------#
 def find_first_tracker_index(vr_sys):
     """Return the index of the first GenericTracker i.e. VIVE Tracker device."""
@@ -42,91 +388,305 @@ def find_first_tracker_index(vr_sys):
     return None
 
 
+class PoseSource:
+    """Interface of the sources of tracker poses sampled by the ViveTrackerThread."""
+
+    name = ""
+
+    def __init__(self):
+        self.serial_number = ""
+
+    def start(self):
+        """Connect to the tracker.
+
+        Raises:
+            RuntimeError: If no tracker is available.
+        """
+
+    def get_pose(self, prediction):
+        """Get the current pose of the tracker.
+
+        Args:
+            prediction: Seconds into the future to predict the pose for, e.g. to
+                compensate for the latency of the tracking pipeline.
+
+        Returns:
+            tuple: (pose_matrix, is_valid). The 3x4 pose matrix (array-like, None
+                if not valid) and whether the pose is valid.
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class OpenVRPoseSource(PoseSource):
+    """Poses of the first VIVE Tracker connected to SteamVR."""
+
+    name = "openvr"
+
+    def __init__(self):
+        super().__init__()
+        self.vr_sys = None
+        self.tracker_index = None
+
+    def start(self):
+        if openvr is None:
+            raise RuntimeError("openvr is not installed, run `pip install openvr`")
+        openvr.init(openvr.VRApplication_Other)
+        self.vr_sys = openvr.VRSystem()
+        print("OpenVR initialized in ViveTrackerThread.")
+
+        self.tracker_index = find_first_tracker_index(self.vr_sys)
+        if self.tracker_index is None:
+            raise RuntimeError(
+                "No VIVE Tracker detected. Check if it is powered on and in view of the base-stations."
+            )
+        self.serial_number = self.vr_sys.getStringTrackedDeviceProperty(
+            self.tracker_index, openvr.Prop_SerialNumber_String
+        )
+        print(f"Using tracker index {self.tracker_index} (serial {self.serial_number})")
+
+    def get_pose(self, prediction):
+        poses = self.vr_sys.getDeviceToAbsoluteTrackingPose(
+            openvr.TrackingUniverseStanding,
+            prediction,
+            openvr.k_unMaxTrackedDeviceCount,
+        )
+        p = poses[self.tracker_index]
+        # View of the 3x4 float32 pose matrix, copied by the history
+        return np.ctypeslib.as_array(p.mDeviceToAbsoluteTracking.m), p.bPoseIsValid
+
+    def stop(self):
+        if self.vr_sys:
+            print("Shutting down OpenVR in ViveTrackerThread...")
+            openvr.shutdown()
+            self.vr_sys = None
+
+
+class FakePoseSource(PoseSource):
+    """Moves a fake tracker on a circle, for testing without a tracker."""
+
+    name = "fake"
+
+    def __init__(self, radius=0.1, period=4.0):
+        """Initialize the source.
+
+        Args:
+            radius: Radius of the circle in meters.
+            period: Seconds per revolution. The tracker also turns once around its
+                vertical axis per revolution.
+        """
+        super().__init__()
+        self.serial_number = "FAKE-TRACKER"
+        self.radius = radius
+        self.period = period
+        self._start_time = None
+
+    def start(self):
+        self._start_time = time.monotonic()
+
+    def get_pose(self, prediction):
+        t = time.monotonic() + prediction - self._start_time
+        angle = 2 * math.pi * t / self.period
+        pose_matrix = np.zeros((3, 4))
+        # SteamVR's y axis points up
+        pose_matrix[:, :3] = Rotation.from_euler("y", angle).as_matrix()
+        pose_matrix[:, 3] = [
+            self.radius * math.cos(angle),
+            1.0,
+            self.radius * math.sin(angle),
+        ]
+        return pose_matrix, True
+
+
+class ReplayPoseSource(PoseSource):
+    """Replays recorded poses in a loop, for testing without a tracker.
+
+    The recording is a .npy file of records with "timestamp", "valid",
+    "position" and "rotation" ([w, x, y, z]) fields, e.g. saved from a /poses
+    request with format=npy. Poses between the recorded samples are
+    interpolated.
+    """
+
+    name = "replay"
+
+    def __init__(self, path):
+        super().__init__()
+        self.serial_number = "REPLAY"
+        records = np.load(path)
+        # Invalid samples have no pose to interpolate, so leave them out
+        records = records[records["valid"].astype(bool)]
+        records = records[np.argsort(records["timestamp"], kind="stable")]
+        if len(records) < 2:
+            raise ValueError(f"{path} has less than two valid poses")
+        self.times = records["timestamp"] - records["timestamp"][0]
+        self.positions = records["position"].astype(float)
+        self.rotations = records["rotation"].astype(float)
+        self.duration = self.times[-1]
+        self._start_time = None
+
+    def start(self):
+        self._start_time = time.monotonic()
+
+    def get_pose(self, prediction):
+        t = (time.monotonic() + prediction - self._start_time) % self.duration
+        after = min(
+            int(np.searchsorted(self.times, t, side="right")), len(self.times) - 1
+        )
+        before = after - 1
+        fraction = (t - self.times[before]) / (self.times[after] - self.times[before])
+        position = self.positions[before] + fraction * (
+            self.positions[after] - self.positions[before]
+        )
+        quat_wxyz = slerp(
+            self.rotations[[before]], self.rotations[[after]], np.array([fraction])
+        )[0]
+        pose_matrix = np.zeros((3, 4))
+        pose_matrix[:, :3] = Rotation.from_quat(quat_wxyz[[1, 2, 3, 0]]).as_matrix()
+        pose_matrix[:, 3] = position
+        return pose_matrix, True
+
+
+POSE_SOURCES = {
+    source.name: source
+    for source in (OpenVRPoseSource, FakePoseSource, ReplayPoseSource)
+}
+
+
+def set_timer_resolution(milliseconds, enable):
+    """Change the resolution of the system timer on Windows.
+
+    With the default of about 15.6 ms, time.sleep is too coarse for sampling at
+    100 Hz or more before Python 3.11. Does nothing on other systems.
+    """
+    if sys.platform != "win32":
+        return
+    winmm = ctypes.windll.winmm
+    if enable:
+        winmm.timeBeginPeriod(milliseconds)
+    else:
+        winmm.timeEndPeriod(milliseconds)
+
+
 # -----------------------------------------------------------------------------#
 # Vive Tracker Thread
 # -----------------------------------------------------------------------------#
 class ViveTrackerThread(threading.Thread):
-    def __init__(self):
+    def __init__(self, pose_source=None, rate=100.0, prediction=0.0, schedule="fixed"):
+        """Initialize the sampling thread.
+
+        Args:
+            pose_source: The PoseSource to sample, an OpenVRPoseSource by default.
+            rate: Samples per second.
+            prediction: Seconds into the future to predict the poses for. Set it to
+                the measured latency of the tracking pipeline, so the pose of a
+                sample is the pose at the time it was taken.
+            schedule: "fixed" to sample at fixed times, independent of how long
+                each sample takes, or "sleep" to sleep 1 / rate seconds after each
+                sample, which lowers the rate and jitters.
+
+        Raises:
+            ValueError: If rate or prediction are out of range or schedule is
+                unknown.
+        """
         super().__init__()
         self.name = "ViveTrackerThread"
+        if not rate > 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        if prediction < 0:
+            raise ValueError(f"prediction must not be negative, got {prediction}")
+        if schedule not in SAMPLING_SCHEDULES:
+            raise ValueError(
+                f"Unknown sampling schedule: {schedule}. "
+                f"Must be one of {SAMPLING_SCHEDULES}"
+            )
+        self.pose_source = (
+            pose_source if pose_source is not None else OpenVRPoseSource()
+        )
+        self.period = 1.0 / rate
+        self.prediction = prediction
+        self.schedule = schedule
+        # Added to time.monotonic() to get the time since the Unix epoch. Measured
+        # once, so the timestamps don't jump when the system clock is adjusted.
+        self.epoch_offset = time.time() - time.monotonic()
+        with pose_lock:
+            sampler_info.update(
+                source=self.pose_source.name,
+                rate=rate,
+                prediction=prediction,
+                schedule=schedule,
+                missed_samples=0,
+                epoch_offset=self.epoch_offset,
+            )
 
     def run(self):
-        global latest_pose_data
-        vr_sys = None
+        set_timer_resolution(1, enable=True)
         try:
-            openvr.init(openvr.VRApplication_Other)
-            vr_sys = openvr.VRSystem()
-            print("OpenVR initialized in ViveTrackerThread.")
-
-            tracker_index = find_first_tracker_index(vr_sys)
-            if tracker_index is None:
-                print(
-                    "No VIVE Tracker detected. Check if it is powered on and in view of the base-stations."
-                )
-                with pose_lock:
-                    latest_pose_data["is_valid"] = False
-                return
-
-            serial = vr_sys.getStringTrackedDeviceProperty(
-                tracker_index, openvr.Prop_SerialNumber_String
-            )
-            print(f"Using tracker index {tracker_index} (serial {serial})")
+            self.pose_source.start()
             with pose_lock:
-                latest_pose_data["serial_number"] = serial
+                tracker_info["serial_number"] = self.pose_source.serial_number
 
+            next_time = time.monotonic()
             while not shutdown_event.is_set():
-                current_time_epoch = time.time()
-                poses = vr_sys.getDeviceToAbsoluteTrackingPose(
-                    openvr.TrackingUniverseStanding,
-                    0,  # Don't predict a future pose, instead get it from now (0 seconds in future)
-                    openvr.k_unMaxTrackedDeviceCount,
+                sample_time = time.monotonic()
+                pose_matrix, is_valid = self.pose_source.get_pose(self.prediction)
+                pose_history.append(
+                    sample_time + self.epoch_offset, pose_matrix, is_valid
                 )
-                p = poses[tracker_index]
 
-                # Create list of lists from the pose matrix
-                pose_matrix = [
-                    [float(val) for val in row] for row in p.mDeviceToAbsoluteTracking
-                ]
+                if self.schedule == "sleep":
+                    time.sleep(self.period)
+                    continue
+                next_time += self.period
+                now = time.monotonic()
+                if now >= next_time:
+                    # Skip the samples we are too late for, instead of taking them
+                    # in a burst
+                    missed = math.floor((now - next_time) / self.period) + 1
+                    next_time += missed * self.period
+                    with pose_lock:
+                        sampler_info["missed_samples"] += missed
+                self._sleep_until(next_time)
 
-                with pose_lock:
-                    latest_pose_data["timestamp"] = current_time_epoch
-                    latest_pose_data["pose_matrix"] = pose_matrix
-                    latest_pose_data["is_valid"] = p.bPoseIsValid
-
-                if p.bPoseIsValid:
-                    # Print to console for debugging
-                    # print(f"time={current_time_epoch:.3f} with pose matrix:")
-                    # print(pose_matrix)
-                    pass
-
-                else:
-                    # print(f"time={current_time_epoch:.3f} Tracker pose not valid")
-                    pass
-
-                time.sleep(0.01)  # Loop at approx 100Hz, adjust as needed
-
-        except openvr.OpenVRError as e:
-            print(f"OpenVR Error in ViveTrackerThread: {e}", file=sys.stderr)
-            with pose_lock:
-                latest_pose_data["is_valid"] = False
         except Exception as e:
-            print(
-                f"An unexpected error occurred in ViveTrackerThread: {e}",
-                file=sys.stderr,
-            )
-            with pose_lock:
-                latest_pose_data["is_valid"] = False
+            print(f"Error in ViveTrackerThread: {e}", file=sys.stderr)
+            # Mark the pose as not available
+            pose_history.append(time.monotonic() + self.epoch_offset, None, False)
         finally:
-            if vr_sys:
-                print("Shutting down OpenVR in ViveTrackerThread...")
-                openvr.shutdown()
+            self.pose_source.stop()
+            set_timer_resolution(1, enable=False)
             print("ViveTrackerThread finished.")
 
+    @staticmethod
+    def _sleep_until(deadline):
+        """Sleep until a time.monotonic() deadline, with sub-millisecond accuracy.
+
+        time.sleep may oversleep by about a millisecond, so the last SLEEP_MARGIN
+        seconds are waited actively. That keeps one CPU core busy for up to
+        SLEEP_MARGIN per sample, about 10% of a core at 100 Hz. The wait yields
+        with time.sleep(0), so the HTTP threads still get the GIL meanwhile, at
+        the cost of waking up a few tens of microseconds late.
+        """
+        remaining = deadline - time.monotonic() - SLEEP_MARGIN
+        if remaining > 0:
+            time.sleep(remaining)
+        while time.monotonic() < deadline:
+            # Release the GIL, so other threads can run
+            time.sleep(0)
+
 
 # -----------------------------------------------------------------------------#
 # HTTP Server
 # -----------------------------------------------------------------------------#
 class PoseHTTPRequestHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests, so clients don't need to connect
+    # for every pose. All responses must then have a Content-Length.
+    protocol_version = "HTTP/1.1"
+    # Send small responses right away instead of waiting for the ACK of the
+    # headers
+    disable_nagle_algorithm = True
+
     def _set_cors_headers(self):
         """Set CORS headers to allow cross-origin requests from web browsers."""
         self.send_header("Access-Control-Allow-Origin", "*")
@@ -142,8 +702,6 @@ class PoseHTTPRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_GET(self):
-        global latest_pose_data
-
         print(f"Received GET request from {self.client_address[0]} for {self.path}")
 
         parsed_path = urllib.parse.urlparse(self.path)
@@ -165,77 +723,187 @@ class PoseHTTPRequestHandler(BaseHTTPRequestHandler):
             # self.wfile.write(json.dumps(response_data).encode("utf-8"))
             # return
 
-            # query_params = urllib.parse.parse_qs(parsed_path.query)
-            # requested_epoch = query_params.get('epoch', [None])[0]
-            # For now, we ignore requested_epoch and return the latest
-
-            with pose_lock:
-                timestamp = latest_pose_data["timestamp"]
-                pose_matrix = latest_pose_data["pose_matrix"]
-                is_valid = latest_pose_data["is_valid"]
-
-            if is_valid and pose_matrix:
-                try:
-                    # Position
-                    pos_x = pose_matrix[0][3]
-                    pos_y = pose_matrix[1][3]
-                    pos_z = pose_matrix[2][3]
-                    position = {"x": pos_x, "y": pos_y, "z": pos_z}
-
-                    # Rotation
-                    rotation_mtx = np.array([row[:3] for row in pose_matrix[:3]])
-                    r = Rotation.from_matrix(rotation_mtx)
-                    quat_xyzw = r.as_quat()  # SciPy returns [x, y, z, w]
-
-                    rotation_quat = {
-                        "w": quat_xyzw[3],  # qw
-                        "x": quat_xyzw[0],  # qx
-                        "y": quat_xyzw[1],  # qy
-                        "z": quat_xyzw[2],  # qz
-                    }
-
-                    response_data = {
-                        "data": {
-                            "timestamp": timestamp,
-                            "pose": {
-                                "position": position,
-                                "rotation": rotation_quat,
-                            },
-                            "serial_number": latest_pose_data.get("serial_number", ""),
-                        }
-                    }
-                    self.send_response(200)
-                    self.send_header("Content-type", "application/json")
-                    self._set_cors_headers()
-                    self.end_headers()
-                    self.wfile.write(json.dumps(response_data).encode("utf-8"))
-                except Exception as e:
-                    print(f"Error processing pose data for HTTP response: {e}")
-                    self.send_response(500)
-                    self.send_header("Content-type", "application/json")
-                    self._set_cors_headers()
-                    self.end_headers()
-                    error_payload = {
-                        "error": "Internal server error processing pose data",
-                        "details": str(e),
-                    }
-                    self.wfile.write(json.dumps(error_payload).encode("utf-8"))
+            query_params = urllib.parse.parse_qs(parsed_path.query)
+            requested_epoch = query_params.get("epoch", [None])[0]
+            if requested_epoch is not None:
+                self._send_pose_at(requested_epoch)
+                return
 
-            else:
-                self.send_response(404)  # Or 503 Service Unavailable
-                self.send_header("Content-type", "application/json")
-                self._set_cors_headers()
-                self.end_headers()
-                error_payload = {"error": "Tracker pose not available or invalid"}
-                if latest_pose_data.get("serial_number"):
-                    error_payload["serial_number"] = latest_pose_data["serial_number"]
-                self.wfile.write(json.dumps(error_payload).encode("utf-8"))
+            status, body = get_latest_pose_response()
+            self.send_response(status)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self._set_cors_headers()
+            self.end_headers()
+            self.wfile.write(body)
+        elif parsed_path.path == "/pose_stream":
+            self._stream_poses(urllib.parse.parse_qs(parsed_path.query))
+        elif parsed_path.path == "/poses":
+            query_params = urllib.parse.parse_qs(parsed_path.query)
+            self._send_poses({key: values[0] for key, values in query_params.items()})
+        elif parsed_path.path == "/stats":
+            self._send_stats()
         else:
+            body = b"Endpoint not found. Use /pose"
             self.send_response(404)
             self.send_header("Content-type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
             self._set_cors_headers()
             self.end_headers()
-            self.wfile.write(b"Endpoint not found. Use /pose")
+            self.wfile.write(body)
+
+    def do_POST(self):
+        print(f"Received POST request from {self.client_address[0]} for {self.path}")
+
+        if urllib.parse.urlparse(self.path).path != "/poses":
+            # The unread body would be taken for the next request
+            self.close_connection = True
+            self._send_json(404, {"error": "Endpoint not found. Use /poses"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self.close_connection = True
+            self._send_json(400, {"error": "Invalid Content-Length"})
+            return
+        try:
+            params = json.loads(self.rfile.read(length))
+            if not isinstance(params, dict):
+                raise ValueError("Expected a JSON object")
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid request body: {e}"})
+            return
+        self._send_poses(params)
+
+    def _stream_poses(self, query_params):
+        """Push every new sample to the client until it disconnects."""
+        try:
+            backlog = int(query_params.get("backlog", ["0"])[0])
+        except ValueError:
+            self._send_json(400, {"error": "backlog must be an integer"})
+            return
+        # The stream has no length, it ends when the connection is closed
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-type", "application/octet-stream")
+        self.send_header("Connection", "close")
+        self._set_cors_headers()
+        self.end_headers()
+
+        print(f"Streaming poses to {self.client_address[0]}")
+        num_seen = max(pose_history.num_appended - max(backlog, 0), 0)
+        try:
+            while not shutdown_event.is_set():
+                records, num_seen = pose_history.get_samples_since(
+                    num_seen, timeout=1.0
+                )
+                if len(records) > 0:
+                    self.wfile.write(records.tobytes())
+                    self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            pass
+        print(f"Stopped streaming poses to {self.client_address[0]}")
+
+    def _send_poses(self, params):
+        """Send the poses at the requested times, see get_requested_epochs."""
+        try:
+            epochs = get_requested_epochs(params)
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        poses = pose_history.get_poses_at(epochs)
+
+        if params.get("format") == "npy":
+            buffer = io.BytesIO()
+            np.save(buffer, poses)
+            body = buffer.getvalue()
+            self.send_response(200)
+            self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self._set_cors_headers()
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        response_data = {
+            "data": {
+                "epochs": poses["epoch"].tolist(),
+                "timestamps": poses["timestamp"].tolist(),
+                "valid": poses["valid"].tolist(),
+                "positions": poses["position"].tolist(),
+                # [w, x, y, z]
+                "rotations": poses["rotation"].tolist(),
+                "serial_number": tracker_info["serial_number"],
+            }
+        }
+        self._send_json(200, response_data)
+
+    def _send_pose_at(self, requested_epoch):
+        """Send the pose at the requested time, see PoseHistory.get_pose_at."""
+        try:
+            pose = pose_history.get_pose_at(float(requested_epoch))
+        except ValueError:
+            self._send_json(400, {"error": f"Invalid epoch: {requested_epoch}"})
+            return
+        if pose is None:
+            error_payload = {
+                "error": f"Tracker pose not available or invalid at {requested_epoch}"
+            }
+            if tracker_info["serial_number"]:
+                error_payload["serial_number"] = tracker_info["serial_number"]
+            self._send_json(404, error_payload)
+            return
+
+        timestamp, position, quat_xyzw, interpolated = pose
+        response_data = {
+            "data": {
+                "timestamp": float(timestamp),
+                "pose": {
+                    "position": {
+                        "x": float(position[0]),
+                        "y": float(position[1]),
+                        "z": float(position[2]),
+                    },
+                    "rotation": {
+                        "w": float(quat_xyzw[3]),
+                        "x": float(quat_xyzw[0]),
+                        "y": float(quat_xyzw[1]),
+                        "z": float(quat_xyzw[2]),
+                    },
+                },
+                "interpolated": interpolated,
+                "serial_number": tracker_info["serial_number"],
+            }
+        }
+        self._send_json(200, response_data)
+
+    def _send_stats(self):
+        """Send the sampler settings and the intervals between recent samples."""
+        intervals = pose_history.get_sample_intervals(STATS_NUM_SAMPLES)
+        with pose_lock:
+            stats = dict(sampler_info)
+        stats["num_samples"] = pose_history.num_appended
+        # Lets clients estimate the offset between their clock and the one the
+        # samples are stamped with
+        stats["time"] = time.monotonic() + stats["epoch_offset"]
+        if len(intervals) > 0:
+            stats["measured_rate"] = float(1.0 / np.mean(intervals))
+            stats["intervals"] = {
+                "mean": float(np.mean(intervals)),
+                "std": float(np.std(intervals)),
+                "min": float(np.min(intervals)),
+                "max": float(np.max(intervals)),
+            }
+        self._send_json(200, stats)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self._set_cors_headers()
+        self.end_headers()
+        self.wfile.write(body)
 
 
 class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
@@ -249,17 +917,68 @@ class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
 # -----------------------------------------------------------------------------#
 # Main
 # -----------------------------------------------------------------------------#
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--port", type=int, default=3001, help="HTTP server port.")
+    parser.add_argument(
+        "--rate", type=float, default=100.0, help="Tracker samples per second."
+    )
+    parser.add_argument(
+        "--prediction",
+        type=float,
+        default=0.0,
+        help="Seconds to predict the poses ahead, to compensate for the measured "
+        "latency of the tracking pipeline.",
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=SAMPLING_SCHEDULES,
+        default="fixed",
+        help="fixed: sample at fixed times. sleep: sleep 1 / rate seconds between "
+        "samples (the old behavior).",
+    )
+    parser.add_argument(
+        "--source",
+        choices=sorted(POSE_SOURCES),
+        default="openvr",
+        help="Where the poses come from. fake and replay don't need a tracker.",
+    )
+    parser.add_argument(
+        "--replay_file",
+        help=".npy file of recorded poses for --source replay, e.g. from /poses "
+        "with format=npy.",
+    )
+    args = parser.parse_args()
+    if args.source == "replay" and args.replay_file is None:
+        parser.error("--source replay requires --replay_file")
+    return args
+
+
 def main():
+    global pose_history
+
+    args = parse_args()
+    pose_history = PoseHistory(max(int(POSE_HISTORY_SECONDS * args.rate), 2))
+    if args.source == "replay":
+        pose_source = ReplayPoseSource(args.replay_file)
+    else:
+        pose_source = POSE_SOURCES[args.source]()
+
     # Start the Vive Tracker thread
-    tracker_thread = ViveTrackerThread()
+    tracker_thread = ViveTrackerThread(
+        pose_source,
+        rate=args.rate,
+        prediction=args.prediction,
+        schedule=args.schedule,
+    )
     tracker_thread.daemon = (
         True  # Allow main program to exit even if this thread is running
     )
     tracker_thread.start()
-    print("ViveTrackerThread started.")
+    print(f"ViveTrackerThread started ({pose_source.name} source, {args.rate} Hz).")
 
     # Start the HTTP server
-    server_address = ("0.0.0.0", 3001)
+    server_address = ("0.0.0.0", args.port)
     httpd = ThreadingHTTPServer(server_address, PoseHTTPRequestHandler)
     print(f"HTTP server listening on {server_address[0]}:{server_address[1]}...")
 
@@ -15,6 +15,10 @@ import requests
 from scipy.spatial.transform import Rotation
 from vpython import arrow, box, button, canvas, color, mag, rate, vector
 
+# Only needs numpy, see custom_classes/pose_records.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from custom_classes.pose_records import STREAM_RECORD_DTYPE, StreamRecordReader
+
 # -----------------------------------------------------------------------------#
 # Configuration
 # -----------------------------------------------------------------------------#
@@ -28,6 +32,9 @@ except Exception as e:
     sys.exit(1)
 
 POSE_ENDPOINT = f"{VIVE_SERVER_URL}/pose"
+POSE_STREAM_ENDPOINT = f"{VIVE_SERVER_URL}/pose_stream"
+# Poll /pose instead if no pose was pushed for this many seconds
+POSE_STREAM_MAX_AGE = 0.5
 
 # Global variable to store the latest goal state
 latest_goal_state = None
@@ -35,6 +42,11 @@ latest_goal_state = None
 # Global variable to store reference to set_external_reference_pose function
 set_external_reference_callback = None
 
+# Latest pose pushed by the tracker server (None if not valid) and the
+# time.monotonic() it was received at
+latest_streamed_pose = None
+latest_streamed_pose_time = -float("inf")
+
 # HTTP Server for receiving goal state
 import threading
 from http.server import BaseHTTPRequestHandler, HTTPServer
@@ -88,8 +100,55 @@ def run_goal_state_server(port=3003):
 # -----------------------------------------------------------------------------#
 # Helpers
 # -----------------------------------------------------------------------------#
+def receive_pose_stream():
+    """Keep latest_streamed_pose up to date with the poses pushed by the server."""
+    global latest_streamed_pose, latest_streamed_pose_time
+    while True:
+        reader = StreamRecordReader()
+        try:
+            with requests.get(
+                POSE_STREAM_ENDPOINT, stream=True, timeout=(3.0, 5.0)
+            ) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(
+                    chunk_size=STREAM_RECORD_DTYPE.itemsize
+                ):
+                    records = reader.feed(chunk)
+                    if len(records) == 0:
+                        continue
+                    # Only the newest pose is shown
+                    record = records[-1]
+                    pose_data = None
+                    if record["valid"]:
+                        position = record["position"]
+                        rotation = record["rotation"]
+                        pose_data = {
+                            "timestamp": float(record["timestamp"]),
+                            "pose": {
+                                "position": {
+                                    "x": float(position[0]),
+                                    "y": float(position[1]),
+                                    "z": float(position[2]),
+                                },
+                                "rotation": {
+                                    "w": float(rotation[0]),
+                                    "x": float(rotation[1]),
+                                    "y": float(rotation[2]),
+                                    "z": float(rotation[3]),
+                                },
+                            },
+                        }
+                    latest_streamed_pose = pose_data
+                    latest_streamed_pose_time = time.monotonic()
+        except requests.RequestException as e:
+            print(f"Pose stream failed, polling {POSE_ENDPOINT} instead: {e}")
+        time.sleep(5)
+
+
 def fetch_pose_from_server():
     """Fetch pose data from the HTTP service."""
+    if time.monotonic() - latest_streamed_pose_time < POSE_STREAM_MAX_AGE:
+        return latest_streamed_pose, latest_streamed_pose is not None
     try:
         response = requests.get(POSE_ENDPOINT, timeout=0.1)
         if response.status_code == 200:
@@ -143,6 +202,11 @@ def track_pose():
     goal_server_thread.daemon = True  # Daemonize thread to exit when main thread exits
     goal_server_thread.start()
 
+    # Receive the poses pushed by the tracker server
+    pose_stream_thread = threading.Thread(target=receive_pose_stream)
+    pose_stream_thread.daemon = True
+    pose_stream_thread.start()
+
     external_ref_x_arrow = None
     external_ref_y_arrow = None
     external_ref_z_arrow = None